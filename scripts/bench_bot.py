@@ -0,0 +1,114 @@
+"""
+Benchmark of Telegram notification tasks against a local fake Telegram Bot API server
+
+Compares the old way of running a task (new event loop and new bot session
+per task, as `asyncio.run` in src/bot/bot.py did) with the persistent worker
+loop of src/bot/worker.py that keeps one loop and one aiohttp session for the
+whole worker process. Tasks are called directly, without a broker, so only
+the loop and connection handling differs between the runs.
+
+Usage:
+    PYTHONPATH=.:src python scripts/bench_bot.py --tasks 2000
+"""
+import argparse
+import asyncio
+import threading
+import time
+
+from aiohttp import web
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+from src.bot.worker import WorkerLoop
+
+
+TOKEN = "123456:TEST-benchmark-token"
+
+
+async def send_message(request: web.Request) -> web.Response:
+    data = await request.post()
+    return web.json_response({
+        "ok": True,
+        "result": {
+            "message_id": 1,
+            "date": int(time.time()),
+            "chat": {"id": int(data.get("chat_id", 1)), "type": "private"},
+            "text": data.get("text", ""),
+        },
+    })
+
+
+def start_fake_telegram(port: int) -> str:
+    """
+    Serve sendMessage of the Bot API from a background thread
+
+    Args:
+        port (int): local port to listen on
+
+    Returns:
+        str: base url of the server
+    """
+    app = web.Application()
+    app.router.add_post("/bot{token}/sendMessage", send_message)
+    runner = web.AppRunner(app, access_log=None)
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+
+    def serve():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, "127.0.0.1", port).start())
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=serve, daemon=True).start()
+    started.wait()
+    return f"http://127.0.0.1:{port}"
+
+
+def make_bot(base_url: str) -> Bot:
+    return Bot(token=TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(base_url)))
+
+
+def bench_loop_per_task(base_url: str, tasks: int) -> float:
+    async def task(i: int):
+        bot = make_bot(base_url)
+        try:
+            await bot.send_message(i, f"message {i}")
+        finally:
+            await bot.session.close()
+
+    start = time.perf_counter()
+    for i in range(tasks):
+        asyncio.run(task(i))
+    return tasks / (time.perf_counter() - start)
+
+
+def bench_worker_loop(base_url: str, tasks: int) -> float:
+    worker_loop = WorkerLoop()
+    worker_loop.start()
+    bot = make_bot(base_url)
+
+    start = time.perf_counter()
+    for i in range(tasks):
+        worker_loop.run(bot.send_message(i, f"message {i}"))
+    rate = tasks / (time.perf_counter() - start)
+
+    worker_loop.stop(bot.session.close())
+    return rate
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tasks", type=int, default=2000)
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+
+    base_url = start_fake_telegram(args.port)
+    print(f"loop and session per task: {bench_loop_per_task(base_url, args.tasks):8.1f} tasks/sec")
+    print(f"persistent worker loop:    {bench_worker_loop(base_url, args.tasks):8.1f} tasks/sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Micro-benchmark of the cost of encoding one chat message for its recipients
+
+Compares the old fan-out, where every recipient got its own dict with
+isMyMessage and `send_json` encoded it again with the stdlib json module,
+with the shared Frame of src/api/protocol.py that encodes the payload with
+orjson at most once per protocol. Only encoding is measured, sockets are not
+involved.
+
+Usage:
+    PYTHONPATH=.:src python scripts/bench_fanout.py --rounds 2000
+"""
+import argparse
+import json
+import time
+from datetime import datetime
+
+from src.api.protocol import Frame, COMPACT_PROTOCOL, JSON_PROTOCOL
+
+
+RECIPIENTS = (2, 50, 1000)
+
+
+def make_payload() -> dict:
+    return {
+        "type": "message",
+        "message_id": 12345678901234,
+        "chat_id": 42,
+        "sender_id": 1,
+        "content": "Привет! How is the benchmark going? " * 3,
+        "time": datetime.now().isoformat(),
+    }
+
+
+def bench_per_recipient(recipients: int, rounds: int) -> float:
+    payload = make_payload()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for user_id in range(recipients):
+            data = {**payload, "isMyMessage": payload["sender_id"] == user_id}
+            json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+    return (time.perf_counter() - start) / rounds * 1e6
+
+
+def bench_frame(recipients: int, rounds: int, protocols: tuple) -> float:
+    payload = make_payload()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        frame = Frame(payload)
+        frame.json
+        for user_id in range(recipients):
+            frame.encode(protocols[user_id % len(protocols)], user_id)
+    return (time.perf_counter() - start) / rounds * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'recipients':>10} {'per recipient':>15} {'frame json':>12} {'frame compact':>15} {'frame mixed':>13}  (usec per message)")
+    for recipients in RECIPIENTS:
+        rounds = max(1, args.rounds * 2 // recipients)
+        print(
+            f"{recipients:>10}"
+            f" {bench_per_recipient(recipients, rounds):>15.1f}"
+            f" {bench_frame(recipients, rounds, (JSON_PROTOCOL,)):>12.1f}"
+            f" {bench_frame(recipients, rounds, (COMPACT_PROTOCOL,)):>15.1f}"
+            f" {bench_frame(recipients, rounds, (COMPACT_PROTOCOL, JSON_PROTOCOL)):>13.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+Benchmark of the hot message/membership queries with and without indexes
+
+Seeds a separate database with users, two-member chats and messages, then
+prints query plans and latencies of the history, membership, user chats and
+duplicate chat queries before and after creating the indexes declared in
+`src/db/models.py`. Messages are partitioned by month as in the migrated
+schema, the tables are created from the models and completed by
+`partition_messages`.
+
+Usage:
+    PYTHONPATH=. python scripts/bench_indexes.py --users 2000 --chats 20000 --messages 2000000
+"""
+import argparse
+import statistics
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, text
+
+from src.db.config import DB_USER, DB_PASS, DB_HOST
+from src.db.db import Base
+from src.db.models import *
+from src.db.partitions import PARTITION_NAME, addMonths
+
+
+INDEXES = {
+    'messages': ['ix_messages_chat_id_id'],
+    'chatmembers': ['ix_chatmembers_chat_id_user_id', 'ix_chatmembers_user_id_chat_id'],
+}
+
+QUERIES = {
+    'history page': (
+        "SELECT * FROM messages WHERE chat_id = :chat_id ORDER BY id DESC LIMIT 51"
+    ),
+    'history page with cursor': (
+        "SELECT * FROM messages WHERE chat_id = :chat_id AND id < :before_id ORDER BY id DESC LIMIT 51"
+    ),
+    'chat members': (
+        "SELECT * FROM chatmembers WHERE chat_id = :chat_id"
+    ),
+    'user chats': (
+        "SELECT cm.chat_id, cm.user_id FROM chatmembers cm "
+        "WHERE cm.chat_id IN (SELECT chat_id FROM chatmembers WHERE user_id = :user_id) AND cm.user_id != :user_id"
+    ),
+    'duplicate chat check': (
+        "SELECT chats.id FROM chats JOIN chatmembers ON chats.id = chatmembers.chat_id "
+        "WHERE chatmembers.user_id IN (:user_id, :user_id2) GROUP BY chats.id HAVING count(*) > 1"
+    ),
+}
+
+
+def partition_messages(conn, messages: int):
+    """
+    Give messages what the migrations create besides the models: the id default and
+    monthly partitions covering the seeded messages, plus the default partition
+
+    Args:
+        conn (Connection): connection to benchmark database
+        messages (int): number of messages, one per second up to now
+    """
+    conn.execute(text("ALTER TABLE messages ALTER COLUMN id SET DEFAULT nextval('messages_id_seq')"))
+    month = (datetime.now() - timedelta(seconds=messages)).date().replace(day=1)
+    last = datetime.now().date()
+    while month <= last:
+        end = addMonths(month, 1)
+        conn.execute(text(
+            f"CREATE TABLE {PARTITION_NAME.format(month.year, month.month)} "
+            f"PARTITION OF messages FOR VALUES FROM ('{month.isoformat()}') TO ('{end.isoformat()}')"
+        ))
+        month = end
+    conn.execute(text("CREATE TABLE messages_default PARTITION OF messages DEFAULT"))
+
+
+def seed(conn, users: int, chats: int, messages: int):
+    """
+    Fill empty tables with generated data
+
+    Args:
+        conn (Connection): connection to benchmark database
+        users (int): number of users
+        chats (int): number of two-member chats
+        messages (int): number of messages spread over chats
+    """
+    conn.execute(text(
+        "INSERT INTO users (id, username, nickname, hashed_password) "
+        "SELECT g, 'user' || g, 'nick' || g, 'password' FROM generate_series(1, :n) g"
+    ), {'n': users})
+    conn.execute(text(
+        "INSERT INTO chats (id, chat_name) SELECT g, '.' FROM generate_series(1, :n) g"
+    ), {'n': chats})
+    conn.execute(text(
+        "INSERT INTO chatmembers (chat_id, user_id) "
+        "SELECT g, 1 + (g * 7919) % :users FROM generate_series(1, :n) g "
+        "UNION ALL "
+        "SELECT g, 1 + (g * 7919 + 1 + g % (:users - 1)) % :users FROM generate_series(1, :n) g"
+    ), {'n': chats, 'users': users})
+    conn.execute(text(
+        "INSERT INTO messages (chat_id, sender_id, text, time) "
+        "SELECT 1 + (random() * (:chats - 1))::int, 1 + (random() * (:users - 1))::int, md5(g::text), "
+        "now() - (:n - g) * interval '1 second' FROM generate_series(1, :n) g"
+    ), {'n': messages, 'chats': chats, 'users': users})
+    conn.execute(text("ANALYZE"))
+
+
+def sample_params(conn) -> dict:
+    """
+    Pick parameters of a busy chat and its members for the benchmarked queries
+
+    Args:
+        conn (Connection): connection to benchmark database
+
+    Returns:
+        dict: bind parameters for QUERIES
+    """
+    chat_id = conn.execute(text(
+        "SELECT chat_id FROM messages GROUP BY chat_id ORDER BY count(*) DESC LIMIT 1"
+    )).scalar()
+    user_id, user_id2 = [row.user_id for row in conn.execute(text(
+        "SELECT user_id FROM chatmembers WHERE chat_id = :chat_id ORDER BY user_id LIMIT 2"
+    ), {'chat_id': chat_id})]
+    before_id = conn.execute(text(
+        "SELECT id FROM messages WHERE chat_id = :chat_id ORDER BY id LIMIT 1 OFFSET 10"
+    ), {'chat_id': chat_id}).scalar()
+    return {'chat_id': chat_id, 'user_id': user_id, 'user_id2': user_id2, 'before_id': before_id or 0}
+
+
+def run(conn, params: dict, repeat: int):
+    """
+    Print plan and median latency of every benchmarked query
+
+    Args:
+        conn (Connection): connection to benchmark database
+        params (dict): bind parameters for QUERIES
+        repeat (int): number of timed runs per query
+    """
+    for name, sql in QUERIES.items():
+        plan = conn.execute(text(f"EXPLAIN (ANALYZE, BUFFERS) {sql}"), params).scalars().all()
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            conn.execute(text(sql), params).fetchall()
+            timings.append((time.perf_counter() - start) * 1000)
+        print(f"--- {name}: median {statistics.median(timings):.3f} ms")
+        print("\n".join(plan))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default='chat_bench', help='name of database created for benchmark')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--chats', type=int, default=20000)
+    parser.add_argument('--messages', type=int, default=2000000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    admin = create_engine(f"postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}/postgres", isolation_level='AUTOCOMMIT')
+    with admin.connect() as conn:
+        conn.execute(text(f'DROP DATABASE IF EXISTS "{args.db}"'))
+        conn.execute(text(f'CREATE DATABASE "{args.db}"'))
+    admin.dispose()
+
+    engine = create_engine(f"postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}/{args.db}")
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        partition_messages(conn, args.messages)
+        for table, indexes in INDEXES.items():
+            for index in indexes:
+                conn.execute(text(f"DROP INDEX {index}"))
+        seed(conn, args.users, args.chats, args.messages)
+
+    with engine.connect() as conn:
+        params = sample_params(conn)
+        print("===== without indexes")
+        run(conn, params, args.repeat)
+
+    with engine.begin() as conn:
+        for table, indexes in INDEXES.items():
+            for index in Base.metadata.tables[table].indexes:
+                if index.name in indexes:
+                    index.create(conn)
+        conn.execute(text("ANALYZE"))
+
+    with engine.connect() as conn:
+        print("===== with indexes")
+        run(conn, params, args.repeat)
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
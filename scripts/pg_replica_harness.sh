@@ -0,0 +1,148 @@
+#!/usr/bin/env bash
+#
+# Routing of queries between primary and replica against two local Postgres clusters, without docker
+#
+# Starts a primary and a streaming replica made with pg_basebackup in a temporary
+# directory, migrates the primary and checks that:
+#   - queries of readOnly CRUD functions go to the replica,
+#   - other queries, readOnly ones inside primaryOnly and all writes go to the primary,
+#   - reads of a user who just wrote stick to the primary, on other workers too,
+#     reads of other users don't,
+#   - a user written on the primary becomes visible through the replica.
+#
+# Needs initdb, pg_ctl and pg_basebackup of PostgreSQL 13+ in PATH (or PG_BIN) and
+# the project dependencies installed, and Redis on REDIS_HOST (localhost by default).
+# Clusters are removed on exit unless KEEP=1.
+#
+# Usage:
+#     scripts/pg_replica_harness.sh
+#     PRIMARY_PORT=6432 REPLICA_PORT=6433 KEEP=1 scripts/pg_replica_harness.sh
+#
+set -euo pipefail
+
+ROOT="$(cd "$(dirname "$0")/.." && pwd)"
+PG_BIN="${PG_BIN:-$(pg_config --bindir 2>/dev/null || dirname "$(command -v initdb)")}"
+PRIMARY_PORT="${PRIMARY_PORT:-55432}"
+REPLICA_PORT="${REPLICA_PORT:-55433}"
+WORKDIR="$(mktemp -d)"
+
+cleanup() {
+    "$PG_BIN/pg_ctl" -D "$WORKDIR/replica" -m fast stop >/dev/null 2>&1 || true
+    "$PG_BIN/pg_ctl" -D "$WORKDIR/primary" -m fast stop >/dev/null 2>&1 || true
+    if [ "${KEEP:-0}" = "1" ]; then
+        echo "Clusters kept in $WORKDIR"
+    else
+        rm -rf "$WORKDIR"
+    fi
+}
+trap cleanup EXIT
+
+echo "Starting primary on port $PRIMARY_PORT"
+"$PG_BIN/initdb" -D "$WORKDIR/primary" -U postgres --auth=trust >/dev/null
+cat >> "$WORKDIR/primary/postgresql.conf" <<EOF
+port = $PRIMARY_PORT
+listen_addresses = '127.0.0.1'
+unix_socket_directories = '$WORKDIR'
+wal_level = replica
+max_wal_senders = 4
+EOF
+"$PG_BIN/pg_ctl" -D "$WORKDIR/primary" -l "$WORKDIR/primary.log" -w start >/dev/null
+"$PG_BIN/createdb" -h 127.0.0.1 -p "$PRIMARY_PORT" -U postgres chat
+
+echo "Starting replica on port $REPLICA_PORT"
+"$PG_BIN/pg_basebackup" -h 127.0.0.1 -p "$PRIMARY_PORT" -U postgres -D "$WORKDIR/replica" -R -X stream
+echo "port = $REPLICA_PORT" >> "$WORKDIR/replica/postgresql.auto.conf"
+"$PG_BIN/pg_ctl" -D "$WORKDIR/replica" -l "$WORKDIR/replica.log" -w start >/dev/null
+
+export DB_HOST="127.0.0.1:$PRIMARY_PORT"
+export DB_USER=postgres
+export DB_PASS=postgres
+export DB_NAME=chat
+export DB_REPLICA_HOSTS="127.0.0.1:$REPLICA_PORT"
+export DB_READ_YOUR_WRITES=2
+export REDIS_HOST="${REDIS_HOST:-localhost}"
+export PYTHONPATH="$ROOT:$ROOT/src"
+
+echo "Migrating primary"
+(cd "$ROOT/src" && alembic upgrade head >/dev/null)
+
+python - "$PRIMARY_PORT" "$REPLICA_PORT" <<'EOF'
+import asyncio
+import sys
+import time
+
+from sqlalchemy import select, func, update
+
+from src.api.cache import read_your_writes_until, write_marks
+from src.db import crud
+from src.db.db import async_session_maker, readOnly, primaryOnly, current_user, sticky_until
+from src.db.models import User
+
+PRIMARY_PORT, REPLICA_PORT = int(sys.argv[1]), int(sys.argv[2])
+
+
+@readOnly
+async def readPort(session):
+    return await session.scalar(select(func.inet_server_port()))
+
+
+async def port(session):
+    return await session.scalar(select(func.inet_server_port()))
+
+
+async def authenticate(uid):
+    """Start a request of user as get_current_uid does, on any worker"""
+    current_user.set(uid)
+    sticky_until.set(await read_your_writes_until(uid))
+
+
+def check(name, actual, expected):
+    print(f"{'ok  ' if actual == expected else 'FAIL'} {name}: {actual}")
+    if actual != expected:
+        sys.exit(1)
+
+
+async def main():
+    async with async_session_maker() as session:
+        check("readOnly query goes to replica", await readPort(session), REPLICA_PORT)
+        check("other query goes to primary", await port(session), PRIMARY_PORT)
+        with primaryOnly():
+            check("readOnly query inside primaryOnly goes to primary", await readPort(session), PRIMARY_PORT)
+
+    async with async_session_maker() as session:
+        user_id = await crud.userAdd("harness", "harness", "-", session)
+    for _ in range(50):
+        async with async_session_maker() as session:
+            if any(user["id"] == user_id for user in await crud.userGetAll(session)):
+                break
+        await asyncio.sleep(0.1)
+    else:
+        check("write replicated", False, True)
+    print("ok   write replicated to replica")
+
+    await authenticate(user_id)
+    async with async_session_maker() as session:
+        await session.execute(update(User).where(User.id == user_id).values(tg_id=1))
+        check("read in session after write goes to primary", await readPort(session), PRIMARY_PORT)
+        await session.commit()
+    await asyncio.gather(*write_marks)
+    async with async_session_maker() as session:
+        check("read of writer sticks to primary", await readPort(session), PRIMARY_PORT)
+
+    sticky_until.set(0.0)
+    await authenticate(user_id)
+    async with async_session_maker() as session:
+        check("read of writer on another worker sticks to primary", await readPort(session), PRIMARY_PORT)
+
+    await authenticate(user_id + 1)
+    async with async_session_maker() as session:
+        check("read of other user goes to replica", await readPort(session), REPLICA_PORT)
+
+    time.sleep(2.1)
+    await authenticate(user_id)
+    async with async_session_maker() as session:
+        check("writer returns to replica after window", await readPort(session), REPLICA_PORT)
+
+
+asyncio.run(main())
+EOF
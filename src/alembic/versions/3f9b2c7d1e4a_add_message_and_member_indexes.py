@@ -0,0 +1,35 @@
+"""add message and member indexes
+
+Revision ID: 3f9b2c7d1e4a
+Revises: c133bca909f6
+Create Date: 2026-10-18 10:12:41.204518
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f9b2c7d1e4a'
+down_revision: Union[str, None] = 'c133bca909f6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # duplicated memberships would break the unique index
+    op.execute(
+        "DELETE FROM chatmembers a USING chatmembers b "
+        "WHERE a.chat_id = b.chat_id AND a.user_id = b.user_id AND a.id > b.id"
+    )
+    op.create_index('ix_messages_chat_id_id', 'messages', ['chat_id', 'id'], unique=False)
+    op.create_index('ix_chatmembers_chat_id_user_id', 'chatmembers', ['chat_id', 'user_id'], unique=True)
+    op.create_index('ix_chatmembers_user_id_chat_id', 'chatmembers', ['user_id', 'chat_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_chatmembers_user_id_chat_id', table_name='chatmembers')
+    op.drop_index('ix_chatmembers_chat_id_user_id', table_name='chatmembers')
+    op.drop_index('ix_messages_chat_id_id', table_name='messages')
@@ -0,0 +1,31 @@
+"""add read state to chatmembers
+
+Revision ID: 5c0b8e3f7a19
+Revises: d4e7a2c91f35
+Create Date: 2026-10-18 15:04:11.630412
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5c0b8e3f7a19'
+down_revision: Union[str, None] = 'd4e7a2c91f35'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('chatmembers', sa.Column('last_read_message_id', sa.BigInteger(), nullable=True))
+    # Existing history counts as read, so upgrading doesn't flood every chat with unread badges
+    op.execute(
+        "UPDATE chatmembers SET last_read_message_id = chats.last_message_id "
+        "FROM chats WHERE chats.id = chatmembers.chat_id"
+    )
+
+
+def downgrade() -> None:
+    op.drop_column('chatmembers', 'last_read_message_id')
@@ -0,0 +1,35 @@
+"""add last message to chats
+
+Revision ID: 8a1d5e0b7c23
+Revises: 3f9b2c7d1e4a
+Create Date: 2026-10-18 11:03:17.518094
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8a1d5e0b7c23'
+down_revision: Union[str, None] = '3f9b2c7d1e4a'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('chats', sa.Column('last_message_id', sa.Integer(), nullable=True))
+    op.add_column('chats', sa.Column('last_message_text', sa.String(), nullable=True))
+    op.add_column('chats', sa.Column('last_message_time', sa.DateTime(), nullable=True))
+    op.execute(
+        "UPDATE chats SET last_message_id = m.id, last_message_text = m.text, last_message_time = m.time "
+        "FROM (SELECT DISTINCT ON (chat_id) id, chat_id, text, time FROM messages ORDER BY chat_id, id DESC) m "
+        "WHERE chats.id = m.chat_id"
+    )
+
+
+def downgrade() -> None:
+    op.drop_column('chats', 'last_message_time')
+    op.drop_column('chats', 'last_message_text')
+    op.drop_column('chats', 'last_message_id')
@@ -0,0 +1,30 @@
+"""bigint message ids
+
+Revision ID: b62e4f19a0d7
+Revises: 8a1d5e0b7c23
+Create Date: 2026-10-18 12:26:52.730416
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b62e4f19a0d7'
+down_revision: Union[str, None] = '8a1d5e0b7c23'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.alter_column('messages', 'id', type_=sa.BigInteger(), existing_type=sa.Integer(), existing_nullable=False)
+    op.execute("ALTER SEQUENCE messages_id_seq AS bigint")
+    op.alter_column('chats', 'last_message_id', type_=sa.BigInteger(), existing_type=sa.Integer(), existing_nullable=True)
+
+
+def downgrade() -> None:
+    op.alter_column('chats', 'last_message_id', type_=sa.Integer(), existing_type=sa.BigInteger(), existing_nullable=True)
+    op.execute("ALTER SEQUENCE messages_id_seq AS integer")
+    op.alter_column('messages', 'id', type_=sa.Integer(), existing_type=sa.BigInteger(), existing_nullable=False)
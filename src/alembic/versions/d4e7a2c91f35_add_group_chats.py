@@ -0,0 +1,26 @@
+"""add group chats
+
+Revision ID: d4e7a2c91f35
+Revises: b62e4f19a0d7
+Create Date: 2026-10-18 14:12:40.281655
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd4e7a2c91f35'
+down_revision: Union[str, None] = 'b62e4f19a0d7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('chats', sa.Column('is_group', sa.Boolean(), server_default=sa.false(), nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_column('chats', 'is_group')
@@ -0,0 +1,121 @@
+"""partition messages by month
+
+Revision ID: f3a9c6d07b52
+Revises: e81f6a4d2b90
+Create Date: 2026-10-18 16:38:05.912744
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f3a9c6d07b52'
+down_revision: Union[str, None] = 'e81f6a4d2b90'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# Creates monthly partitions messages_yYYYYmMM covering [first, last] months
+CREATE_PARTITIONS = """
+DO $$
+DECLARE
+    month date := date_trunc('month', {first})::date;
+BEGIN
+    WHILE month <= date_trunc('month', {last})::date LOOP
+        EXECUTE 'CREATE TABLE IF NOT EXISTS '
+            || quote_ident('messages_y' || to_char(month, 'YYYY') || 'm' || to_char(month, 'MM'))
+            || ' PARTITION OF messages FOR VALUES FROM (' || quote_literal(month)
+            || ') TO (' || quote_literal((month + interval '1 month')::date) || ')';
+        month := (month + interval '1 month')::date;
+    END LOOP;
+END $$;
+"""
+
+
+def upgrade() -> None:
+    op.drop_index('ix_messages_search_vector', table_name='messages', postgresql_using='gin')
+    op.drop_index('ix_messages_chat_id_id', table_name='messages')
+    op.drop_index('ix_messages_id', table_name='messages')
+    op.execute("ALTER TABLE messages RENAME TO messages_unpartitioned")
+    op.execute("ALTER TABLE messages_unpartitioned RENAME CONSTRAINT messages_pkey TO messages_unpartitioned_pkey")
+
+    op.execute("""
+        CREATE TABLE messages (
+            id bigint NOT NULL DEFAULT nextval('messages_id_seq'),
+            chat_id integer REFERENCES chats (id),
+            sender_id integer REFERENCES users (id),
+            text varchar,
+            time timestamp without time zone NOT NULL,
+            search_vector tsvector GENERATED ALWAYS AS (to_tsvector('simple', coalesce(text, ''))) STORED,
+            CONSTRAINT messages_pkey PRIMARY KEY (id, time)
+        ) PARTITION BY RANGE (time)
+    """)
+    op.create_index('ix_messages_id', 'messages', ['id'], unique=False)
+    op.create_index('ix_messages_chat_id_id', 'messages', ['chat_id', 'id'], unique=False)
+    op.create_index('ix_messages_search_vector', 'messages', ['search_vector'], unique=False, postgresql_using='gin')
+    # Catches rows outside of created partitions, maintenance keeps it empty by creating partitions ahead
+    op.execute("CREATE TABLE messages_default PARTITION OF messages DEFAULT")
+    op.execute(CREATE_PARTITIONS.format(
+        first="coalesce((SELECT min(time) FROM messages_unpartitioned), now())",
+        last="now() + interval '3 months'"
+    ))
+
+    op.execute(
+        "INSERT INTO messages (id, chat_id, sender_id, text, time) "
+        "SELECT id, chat_id, sender_id, text, coalesce(time, now() AT TIME ZONE 'utc') FROM messages_unpartitioned"
+    )
+    op.execute("ALTER SEQUENCE messages_id_seq OWNED BY messages.id")
+    op.drop_table('messages_unpartitioned')
+
+    op.create_table(
+        'message_archives',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('chat_id', sa.Integer(), nullable=True),
+        sa.Column('partition_name', sa.String(), nullable=True),
+        sa.Column('path', sa.String(), nullable=True),
+        sa.Column('min_id', sa.BigInteger(), nullable=True),
+        sa.Column('max_id', sa.BigInteger(), nullable=True),
+        sa.Column('messages_count', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['chat_id'], ['chats.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_message_archives_id', 'message_archives', ['id'], unique=False)
+    op.create_index('ix_message_archives_chat_id_partition_name', 'message_archives', ['chat_id', 'partition_name'], unique=True)
+    op.create_index('ix_message_archives_chat_id_max_id', 'message_archives', ['chat_id', 'max_id'], unique=False)
+
+
+def downgrade() -> None:
+    # Archived partitions are not restored, load them from their files first if needed
+    op.drop_index('ix_message_archives_chat_id_max_id', table_name='message_archives')
+    op.drop_index('ix_message_archives_chat_id_partition_name', table_name='message_archives')
+    op.drop_index('ix_message_archives_id', table_name='message_archives')
+    op.drop_table('message_archives')
+
+    op.execute("ALTER TABLE messages RENAME TO messages_partitioned")
+    op.execute("ALTER TABLE messages_partitioned RENAME CONSTRAINT messages_pkey TO messages_partitioned_pkey")
+    op.drop_index('ix_messages_search_vector', table_name='messages_partitioned', postgresql_using='gin')
+    op.drop_index('ix_messages_chat_id_id', table_name='messages_partitioned')
+    op.drop_index('ix_messages_id', table_name='messages_partitioned')
+    op.execute("""
+        CREATE TABLE messages (
+            id bigint NOT NULL DEFAULT nextval('messages_id_seq'),
+            chat_id integer REFERENCES chats (id),
+            sender_id integer REFERENCES users (id),
+            text varchar,
+            time timestamp without time zone,
+            search_vector tsvector GENERATED ALWAYS AS (to_tsvector('simple', coalesce(text, ''))) STORED,
+            CONSTRAINT messages_pkey PRIMARY KEY (id)
+        )
+    """)
+    op.execute(
+        "INSERT INTO messages (id, chat_id, sender_id, text, time) "
+        "SELECT id, chat_id, sender_id, text, time FROM messages_partitioned"
+    )
+    op.execute("ALTER SEQUENCE messages_id_seq OWNED BY messages.id")
+    op.execute("DROP TABLE messages_partitioned CASCADE")
+    op.create_index('ix_messages_id', 'messages', ['id'], unique=False)
+    op.create_index('ix_messages_chat_id_id', 'messages', ['chat_id', 'id'], unique=False)
+    op.create_index('ix_messages_search_vector', 'messages', ['search_vector'], unique=False, postgresql_using='gin')
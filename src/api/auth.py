@@ -2,12 +2,10 @@ from fastapi import Form, Depends, HTTPException, APIRouter, status, Request, Bo
 from fastapi.responses import RedirectResponse
 from fastapi.templating import Jinja2Templates
 from sqlalchemy.ext.asyncio import AsyncSession
-import jwt
-import datetime
-from src.db.config import SECRET_HASH
 from src.db.services import *
 from src.db.db import *
-from src.api.chat import verify_jwt
+from src.api.security import create_access_token, get_current_uid, TOKEN_COOKIE, TOKEN_LIFETIME
+from src.api import cache
 
 router = APIRouter()
 
@@ -63,17 +61,17 @@ async def login(
         RedirectResponse: set JWT token into cookie and redirect user to main page (/app)
     """
     usr = await usrService.userGetByLogin(user.username, session)
-    if not usr or not usrService.verifyPassword(user.hashed_password, usr['hashed_password']):
+    if not usr or not await usrService.verifyPassword(user.hashed_password, usr, session):
         return RedirectResponse(url="/", status_code=status.HTTP_302_FOUND)
-    token = jwt.encode({"sub": user.username, "userId": usr['id'], "nick": user.nickname, "exp": datetime.datetime.now() + datetime.timedelta(minutes=1440)}, SECRET_HASH, algorithm="HS256")
+    token = create_access_token(usr['id'], user.username, user.nickname)
     response = RedirectResponse(url="/app", status_code=302)
     response.set_cookie(
-        key="access_token", 
+        key=TOKEN_COOKIE, 
         value=token, 
         # httponly=True,
         httponly=False,
-        max_age=1440 * 60,
-        expires=1440 * 60, 
+        max_age=int(TOKEN_LIFETIME.total_seconds()),
+        expires=int(TOKEN_LIFETIME.total_seconds()), 
         # secure=True,
         samesite="lax"
     )
@@ -100,20 +98,21 @@ async def register(
 
 @router.post("/setTgId")
 async def setTgId(
-    request: Request,
     tgId: dict = Body(...),
+    uid: int = Depends(get_current_uid),
     session: AsyncSession=Depends(get_async_session)
 ):
     """
     Set telegram chat id for user
 
     Args:
-        request (Request): request
         tgId (int, optional): telegram chat id
+        uid (int, optional): id of authenticated user
         session (AsyncSession, optional): connection to database
 
     Returns:
         int: user id
     """
-    uid = verify_jwt(request.cookies.get("access_token"))
-    return await usrService.userSetTgId(uid, int(tgId['tgId']), session)
\ No newline at end of file
+    res = await usrService.userSetTgId(uid, int(tgId['tgId']), session)
+    await cache.invalidate_user_profile(uid)
+    return res
\ No newline at end of file
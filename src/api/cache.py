@@ -0,0 +1,398 @@
+import redis.asyncio as aioredis
+from redis.exceptions import WatchError
+from collections import OrderedDict
+from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.db.config import REDIS_HOST, DB_READ_YOUR_WRITES
+from src.db.services import chatMmbrService, chatService, usrService
+from src.db.db import primaryOnly, replica_engines, RoutingSession
+from src.db import partitions
+from src.metrics import CACHE_REQUESTS
+import asyncio
+import json
+import logging
+import time
+
+"""
+    Non-blocking Redis cache shared by the endpoints of one worker
+"""
+
+CACHE_TTL = 300
+HISTORY_CACHE_SIZE = 200
+# Counters of unflushed messages outlive a writer that died before flushing by at most this many seconds
+HISTORY_PENDING_TTL = 60
+LOCAL_CACHE_SIZE = 10000
+LOCAL_CACHE_TTL = 60
+INVALIDATE_CHANNEL = "cache:invalidate"
+READ_YOUR_WRITES_KEY = "rw:{}"
+
+USER_CHATS_HIT = CACHE_REQUESTS.labels("user_chats", "hit")
+USER_CHATS_MISS = CACHE_REQUESTS.labels("user_chats", "miss")
+CHAT_HISTORY_HIT = CACHE_REQUESTS.labels("chat_history", "hit")
+CHAT_HISTORY_MISS = CACHE_REQUESTS.labels("chat_history", "miss")
+
+pool = aioredis.ConnectionPool(host=REDIS_HOST, port=6379, db=0)
+redis_client = aioredis.Redis(connection_pool=pool)
+logger = logging.getLogger(__name__)
+# Pending writes of rw:{uid} keys, referenced until done so they aren't collected
+write_marks = set()
+
+
+def json_serial(obj):
+    """
+    Serialize `datetime` obj into str
+    """
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError("Type not serializable")
+
+
+async def get_json(key: str):
+    """
+    Get cached value
+
+    Args:
+        key (str): cache key
+
+    Returns:
+        Any: decoded value or None if key is missing
+    """
+    cached = await redis_client.get(key)
+    return json.loads(cached) if cached else None
+
+
+async def set_json(key: str, value, ttl: int = CACHE_TTL):
+    """
+    Cache value for ttl seconds
+
+    Args:
+        key (str): cache key
+        value (Any): JSON serializable value
+        ttl (int, optional): time to live in seconds
+    """
+    await redis_client.setex(key, ttl, json.dumps(value, default=json_serial))
+
+
+async def get_user_chats(uid: int):
+    chats = await get_json(f"user_chats:{uid}")
+    (USER_CHATS_HIT if chats is not None else USER_CHATS_MISS).inc()
+    return chats
+
+
+async def set_user_chats(uid: int, chats: list):
+    await set_json(f"user_chats:{uid}", chats)
+
+
+async def invalidate_user_chats(*uids: int):
+    if uids:
+        await redis_client.delete(*[f"user_chats:{uid}" for uid in uids])
+
+
+async def read_your_writes_until(uid: int) -> float:
+    """
+    Get time until which reads of user go to the primary because of a recent write on any worker
+
+    Args:
+        uid (int): user id
+
+    Returns:
+        float: monotonic time, 0 if the user didn't write in the last DB_READ_YOUR_WRITES seconds
+    """
+    if not replica_engines:
+        return 0.0
+    ttl = await redis_client.pttl(READ_YOUR_WRITES_KEY.format(uid))
+    return time.monotonic() + ttl / 1000 if ttl > 0 else 0.0
+
+
+async def mark_write(uid: int):
+    try:
+        await redis_client.set(READ_YOUR_WRITES_KEY.format(uid), 1, px=int(DB_READ_YOUR_WRITES * 1000))
+    except Exception as e:
+        logger.warning(f"Failed to share read-your-writes window of user {uid}: {e}")
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def share_write(session):
+    """
+    Record committed write of user in Redis, so other workers send reads of the user to the primary too
+    """
+    uid = session.info.pop("writer", None)
+    if uid is not None and replica_engines:
+        task = asyncio.get_running_loop().create_task(mark_write(uid))
+        write_marks.add(task)
+        task.add_done_callback(write_marks.discard)
+
+
+async def get_chat_history(chat_id: int, limit: int, load):
+    """
+    Get newest messages of chat from its capped history list, warming the list on miss
+
+    The list keeps the newest HISTORY_CACHE_SIZE messages, newest first. Writers
+    bump a version key next to it, so a warm-up racing with a new message is dropped
+    instead of overwriting the list with a stale page. The list is loaded from the
+    primary, a lagging replica would slip past the version check. While the chat
+    has messages queued by the write-behind writer and not flushed yet, the loaded
+    page lacks them, so it is returned without warming the list.
+
+    Args:
+        chat_id (int): chat id
+        limit (int): number of messages to return, not greater than HISTORY_CACHE_SIZE
+        load (Callable): coroutine function returning newest HISTORY_CACHE_SIZE messages from db
+
+    Returns:
+        list: up to limit messages, newest first
+    """
+    key = f"chat_history:{chat_id}"
+    version_key = f"chat_history_version:{chat_id}"
+    pending_key = f"chat_history_pending:{chat_id}"
+    cached = await redis_client.lrange(key, 0, limit - 1)
+    if cached:
+        CHAT_HISTORY_HIT.inc()
+        return [json.loads(item) for item in cached]
+    CHAT_HISTORY_MISS.inc()
+
+    version, pending = await redis_client.mget(version_key, pending_key)
+    with primaryOnly():
+        messages = await load()
+    if messages and not int(pending or 0):
+        async with redis_client.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(version_key, pending_key)
+                if await pipe.get(version_key) == version and not int(await pipe.get(pending_key) or 0):
+                    pipe.multi()
+                    pipe.delete(key)
+                    pipe.rpush(key, *[json.dumps(message, default=json_serial) for message in messages])
+                    pipe.expire(key, CACHE_TTL)
+                    await pipe.execute()
+            except WatchError:
+                pass
+    return messages[:limit]
+
+
+async def append_chat_history(chat_id: int, message: dict, pending: bool = False):
+    """
+    Push new message to the history list of chat if the list is warm
+
+    Args:
+        chat_id (int): chat id
+        message (dict): message in the format of getMessagesByChatId
+        pending (bool, optional): message is queued by the write-behind writer and not in db yet;
+            warm-ups of the list are skipped until chat_history_flushed is called for it
+    """
+    key = f"chat_history:{chat_id}"
+    version_key = f"chat_history_version:{chat_id}"
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.lpushx(key, json.dumps(message, default=json_serial))
+        pipe.ltrim(key, 0, HISTORY_CACHE_SIZE - 1)
+        pipe.expire(key, CACHE_TTL)
+        pipe.incr(version_key)
+        pipe.expire(version_key, CACHE_TTL)
+        if pending:
+            pipe.incr(f"chat_history_pending:{chat_id}")
+            pipe.expire(f"chat_history_pending:{chat_id}", HISTORY_PENDING_TTL)
+        await pipe.execute()
+
+
+async def chat_history_flushed(counts: dict):
+    """
+    Record that queued messages reached db, so history lists of their chats may be warmed again
+
+    Args:
+        counts (dict): chat id to number of flushed messages
+    """
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for chat_id, count in counts.items():
+            pipe.decrby(f"chat_history_pending:{chat_id}", count)
+        await pipe.execute()
+
+
+class LRUCache:
+    """
+    In-process cache with least recently used eviction and per-entry time to live
+    """
+    MISSING = object()
+
+    def __init__(self, maxsize: int = LOCAL_CACHE_SIZE, ttl: float = LOCAL_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return self.MISSING
+        expires, value = entry
+        if expires < time.monotonic():
+            del self.entries[key]
+            return self.MISSING
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        self.entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+
+members_cache = LRUCache()
+profiles_cache = LRUCache()
+contacts_cache = LRUCache()
+chats_cache = LRUCache()
+archives_cache = LRUCache()
+local_caches = {
+    'members': members_cache, 'profiles': profiles_cache, 'contacts': contacts_cache, 'chats': chats_cache,
+    'archives': archives_cache,
+}
+
+
+async def get_chat_members(session: AsyncSession, chat_id: int) -> frozenset:
+    """
+    Get ids of chat members, from the in-process cache when possible
+
+    Args:
+        session (AsyncSession): connection to db used on cache miss
+        chat_id (int): chat id
+
+    Returns:
+        frozenset: ids of chat members
+    """
+    members = members_cache.get(chat_id)
+    if members is LRUCache.MISSING:
+        # read from the primary: invalidation comes right after a commit a replica may not have yet
+        with primaryOnly():
+            rows = await chatMmbrService.getChatMembersByChatId(session, chat_id)
+        members = frozenset(row['user_id'] for row in rows)
+        members_cache.set(chat_id, members)
+    return members
+
+
+async def has_archives(session: AsyncSession, chat_id: int) -> bool:
+    """
+    Check if chat has archived messages, from the in-process cache when possible.
+    Partitions are archived once a month, a newly archived chat may be
+    reported without archives for up to LOCAL_CACHE_TTL seconds.
+
+    Args:
+        session (AsyncSession): connection to db used on cache miss
+        chat_id (int): chat id
+
+    Returns:
+        bool: True if some messages of chat are archived
+    """
+    newest = archives_cache.get(chat_id)
+    if newest is LRUCache.MISSING:
+        newest = await partitions.getNewestArchivedId(session, chat_id)
+        archives_cache.set(chat_id, newest)
+    return newest is not None
+
+
+async def get_user_profiles(session: AsyncSession, uids) -> dict:
+    """
+    Get profiles of several users, loading all cache misses with one query
+
+    Args:
+        session (AsyncSession): connection to db used on cache miss
+        uids (Iterable[int]): user ids
+
+    Returns:
+        dict: user id to dict containing nickname and tg_id, missing users are skipped
+    """
+    profiles = {}
+    missing = []
+    for uid in uids:
+        profile = profiles_cache.get(uid)
+        if profile is LRUCache.MISSING:
+            missing.append(uid)
+        elif profile is not None:
+            profiles[uid] = profile
+    if missing:
+        loaded = await usrService.usersGetByIds(missing, session)
+        for uid in missing:
+            profiles_cache.set(uid, loaded.get(uid))
+        profiles.update(loaded)
+    return profiles
+
+
+async def get_chat(session: AsyncSession, chat_id: int):
+    """
+    Get name and kind of chat, from the in-process cache when possible
+
+    Args:
+        session (AsyncSession): connection to db used on cache miss
+        chat_id (int): chat id
+
+    Returns:
+        dict or None: dict containing chat_name, host_id and is_group, None if chat doesn't exist
+    """
+    chat = chats_cache.get(chat_id)
+    if chat is LRUCache.MISSING:
+        chat = await chatService.getChatById(session, chat_id)
+        if chat is not None:
+            chats_cache.set(chat_id, chat)
+    return chat
+
+
+async def get_user_contacts(session: AsyncSession, uid: int) -> frozenset:
+    """
+    Get ids of users having a chat with user, from the in-process cache when possible
+
+    Args:
+        session (AsyncSession): connection to db used on cache miss
+        uid (int): user id
+
+    Returns:
+        frozenset: ids of contacts
+    """
+    contacts = contacts_cache.get(uid)
+    if contacts is LRUCache.MISSING:
+        contacts = frozenset(await chatMmbrService.getContactIdsByUserId(session, uid))
+        contacts_cache.set(uid, contacts)
+    return contacts
+
+
+async def invalidate_chat_members(chat_id: int):
+    await publish_invalidation('members', chat_id)
+
+
+async def invalidate_user_contacts(*uids: int):
+    for uid in uids:
+        await publish_invalidation('contacts', uid)
+
+
+async def invalidate_user_profile(uid: int):
+    await publish_invalidation('profiles', uid)
+
+
+async def publish_invalidation(cache_name: str, key: int):
+    """
+    Drop entry from the in-process cache of every worker
+
+    Args:
+        cache_name (str): name of cache in local_caches
+        key (int): key of entry
+    """
+    local_caches[cache_name].invalidate(key)
+    await redis_client.publish(INVALIDATE_CHANNEL, json.dumps({'cache': cache_name, 'key': key}))
+
+
+def handle_invalidation(message: dict):
+    """
+    Apply invalidation published by publish_invalidation
+
+    Args:
+        message (dict): name of cache and key of entry
+    """
+    local_caches[message['cache']].invalidate(message['key'])
+
+
+async def close():
+    """
+    Close connections of the shared pool
+    """
+    await redis_client.aclose()
+    await pool.aclose()
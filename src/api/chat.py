@@ -1,52 +1,45 @@
-from fastapi import APIRouter, status, Request, HTTPException, File, WebSocket, Depends, WebSocketDisconnect
+from fastapi import APIRouter, status, Request, HTTPException, File, WebSocket, Depends, WebSocketDisconnect, Query
 from fastapi.templating import Jinja2Templates
 from src.db.services import *
 from src.db.db import *
 import json
-import jwt
 from src.api.connectionManager import *
-from src.db.config import SECRET_HASH
+from src.api.protocol import Frame
+from src.db.config import MESSAGE_WRITE_BEHIND
+from src.api.security import get_current_uid
+from src.metrics import WS_FRAMES_IN
 from datetime import datetime, timezone
-import redis
+from src.api import cache, unread
+from src.db.writer import message_writer
+from src.db import partitions
+from typing import Optional
 
 
 router = APIRouter()
 templates = Jinja2Templates(directory="templates")
-redis_client = redis.StrictRedis(host=REDIS_HOST, port=6379, db=0)
 
 manager = ConnectionManager()
 
-def verify_jwt(token: str):
-    try:
-        payload = jwt.decode(token, SECRET_HASH, algorithms=["HS256"])
-        return payload.get("userId")
-    except jwt.ExpiredSignatureError:
-        raise HTTPException(status_code=401, detail="JWT Token has expired")
-    except jwt.InvalidTokenError:
-        raise HTTPException(status_code=401, detail="Invalid JWT Token")
-
-def json_serial(obj):
-    """
-    Serialize `datetime` obj into str
-    """
-    if isinstance(obj, datetime):
-        return obj.isoformat()
-    raise TypeError("Type not serializable")
-
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+WS_FRAME_TYPES = {kind: WS_FRAMES_IN.labels(kind) for kind in ('message', 'read', 'pong')}
+# Read receipts of larger chats are pushed only to other connections of the reader
+READ_RECEIPTS_MAX_MEMBERS = 100
 
 @router.get("/getUsers")
-async def getUsers(request: Request, session: AsyncSession = Depends(get_async_session)):
+async def getUsers(uid: int = Depends(get_current_uid), session: AsyncSession = Depends(get_async_session)):
     """
     Endpoint to get user list
 
     Args:
-        request (Request): request
+        uid (int, optional): id of authenticated user
         session (AsyncSession, optional): connection to database
 
     Returns:
         list: list of dicts containing user info
     """
-    uid = verify_jwt(request.cookies.get("access_token"))
     users = await usrService.userGetAll(session)
     return users
 
@@ -68,6 +61,7 @@ async def root(request: Request):
 @router.post("/addChat")
 async def add_chat(
     request: Request,
+    uid: int = Depends(get_current_uid),
     session: AsyncSession = Depends(get_async_session),
 ):
     """
@@ -75,141 +69,371 @@ async def add_chat(
 
     Args:
         request (Request): request
+        uid (int, optional): id of authenticated user
         session (AsyncSession, optional): connection to database
 
     Returns:
         dict: dict containing chat_id of new chat
     """
-    uid = verify_jwt(request.cookies.get("access_token"))
     body = await request.json()
     user_id_2 = body.get("user_id")
+    if type(user_id_2) is not int:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="user_id must be a user id")
+    if user_id_2 == uid:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Can't create chat with yourself")
     chat_id = await chatService.addChat(session, uid, user_id_2)
-    redis_client.delete(f"user_chats:{uid}")
+    await cache.invalidate_chat_members(chat_id)
+    await cache.invalidate_user_contacts(uid, user_id_2)
+    await cache.invalidate_user_chats(uid, user_id_2)
+    return {"chat_id": chat_id}
+
+
+def parse_user_ids(body: dict) -> list:
+    """
+    Get distinct user ids from user_ids of request body
+
+    Args:
+        body (dict): request body
+
+    Raises:
+        HTTPException: 400 if user_ids is not a list of user ids
+
+    Returns:
+        list: user ids, in order of first occurrence
+    """
+    user_ids = body.get("user_ids") or []
+    if not isinstance(user_ids, list):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="user_ids must be a list of user ids")
+    try:
+        return list(dict.fromkeys(int(user_id) for user_id in user_ids))
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="user_ids must be a list of user ids")
+
+
+@router.post("/addGroupChat")
+async def add_group_chat(
+    request: Request,
+    uid: int = Depends(get_current_uid),
+    session: AsyncSession = Depends(get_async_session),
+):
+    """
+    Endpoint to create new group chat
+
+    Args:
+        request (Request): request with chat_name and user_ids of other members
+        uid (int, optional): id of authenticated user, becomes host of chat
+        session (AsyncSession, optional): connection to database
+
+    Returns:
+        dict: dict containing chat_id of new chat
+    """
+    body = await request.json()
+    chat_name = (body.get("chat_name") or "").strip()
+    if not chat_name:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="chat_name is required")
+    user_ids = parse_user_ids(body)
+    chat_id = await chatService.addGroupChat(session, uid, chat_name, user_ids)
+    await cache.invalidate_user_chats(uid, *user_ids)
     return {"chat_id": chat_id}
 
 
+@router.post("/addChatMembers")
+async def add_chat_members(
+    request: Request,
+    uid: int = Depends(get_current_uid),
+    session: AsyncSession = Depends(get_async_session),
+):
+    """
+    Endpoint to add users to group chat, allowed to host of chat only
+
+    Args:
+        request (Request): request with chat_id and user_ids
+        uid (int, optional): id of authenticated user
+        session (AsyncSession, optional): connection to database
+
+    Returns:
+        dict: dict containing ids of added users
+    """
+    body = await request.json()
+    chat_id = body.get("chat_id")
+    chat = await cache.get_chat(session, chat_id)
+    if not chat or not chat['is_group'] or chat['host_id'] != uid:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Only host of group chat can add members")
+    user_ids = parse_user_ids(body)
+    if not user_ids:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="user_ids is required")
+    added = await chatMmbrService.addChatMembers(session, chat_id, user_ids)
+    await cache.invalidate_chat_members(chat_id)
+    await cache.invalidate_user_chats(*added)
+    return {"user_ids": added}
+
+
 @router.get("/getChats")
 async def get_chats(
-    request: Request,
+    uid: int = Depends(get_current_uid),
     session: AsyncSession = Depends(get_async_session),
 ):
     """
     Endpoint to get list of user chat
 
     Args:
-        request (Request): request
+        uid (int, optional): id of authenticated user
         session (AsyncSession, optional): connection to database
 
     Returns:
-        list: list of dicts containing chat info
+        list: list of dicts containing chat info and number of unread messages
     """
-    uid = verify_jwt(request.cookies.get("access_token"))
-    cache_key = f"user_chats:{uid}"
 
-    cached_chats = redis_client.get(cache_key)
-    if cached_chats:
-        return json.loads(cached_chats)
+    chats = await cache.get_user_chats(uid)
+    if not chats:
+        # read from the primary, a list missing a new message would be cached past its invalidation
+        with primaryOnly():
+            chats = await chatService.getUserChats(session, uid)
+        await cache.set_user_chats(uid, chats)
 
-    chats = await chatService.getUserChats(session, uid)
-    redis_client.setex(cache_key, 300, json.dumps(chats, default=json_serial))
+    counts = await unread.get_counts(session, uid)
+    for chat in chats:
+        chat['unread_count'] = counts.get(chat['chat_id'], 0)
     return chats
 
 
 @router.get("/chat/{chat_id}")
 async def get_history(
-    request: Request,
     chat_id: int,
+    before_id: Optional[int] = None,
+    limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+    uid: int = Depends(get_current_uid),
     session: AsyncSession = Depends(get_async_session),
 ):
     """
-    Endpoint to get history of messages
+    Endpoint to get history of messages, one page at a time
 
     Args:
-        request (Request): request
         chat_id (int): chat id
+        before_id (int, optional): id of the oldest message client already has; newest page if None
+        limit (int, optional): max number of messages in page
+        uid (int, optional): id of authenticated user
         session (AsyncSession, optional): connection to database
 
     Returns:
-        dict: uid, online status, uid of another participant, list of messages
+        dict: uid, page of messages (newest first), cursor of next page, online status and uid of another
+            participant for private chats, number of members for group chats
     """
-    uid = verify_jwt(request.cookies.get("access_token"))
-    cache_key = f"chat_history:{chat_id}"
-
-    cached_data = redis_client.get(cache_key)
-    
-    if cached_data:
-        data = json.loads(cached_data)
-        msgs = data['messages']
-        another_uid = data.get('another_uid')
+    uids_set = await cache.get_chat_members(session, chat_id)
+    if uid not in uids_set:
+        # nothing about the chat, its members included, is shown to non-members
+        return {
+            'uid': uid,
+            'messages': [],
+            'next_before_id': None,
+            'isOnline': False,
+            'another_uid': None,
+            'is_group': False,
+            'members_count': 0
+        }
+
+    chat = await cache.get_chat(session, chat_id)
+    is_group = bool(chat and chat['is_group'])
+
+    if before_id is None and limit < cache.HISTORY_CACHE_SIZE:
+        msgs = await cache.get_chat_history(
+            chat_id,
+            limit + 1,
+            lambda: msgService.getMessagesByChatId(session, chat_id, None, cache.HISTORY_CACHE_SIZE)
+        )
     else:
-        chatMembers = await chatMmbrService.getChatMembersByChatId(session, chat_id)
-        uids_set = {item['user_id'] for item in chatMembers}
-        
-        if uid in uids_set:
-            msgs = await msgService.getMessagesByChatId(session, chat_id)
-            another_uid = (uids_set - {uid}).pop() if uids_set - {uid} else None
-            
-            redis_client.setex(cache_key, 300, json.dumps({'messages': msgs, 'another_uid': another_uid}, default=json_serial))
-        else:
-            msgs = []
-            another_uid = None
+        msgs = await msgService.getMessagesByChatId(session, chat_id, before_id, limit + 1)
+
+    if len(msgs) <= limit and await cache.has_archives(session, chat_id):
+        # history in db ends here, continue with archived partitions
+        oldest_id = msgs[-1]['message_id'] if msgs else before_id
+        msgs += await partitions.getArchivedMessages(session, chat_id, oldest_id, limit + 1 - len(msgs))
+
+    another_uid = (uids_set - {uid}).pop() if uids_set - {uid} and not is_group else None
+    has_more = len(msgs) > limit
+    msgs = msgs[:limit]
 
     result = {
         'uid': uid,
         'messages': msgs,
-        'isOnline': manager.is_user_online(another_uid) if another_uid else False,
-        'another_uid': another_uid
+        'next_before_id': msgs[-1]['message_id'] if has_more else None,
+        'isOnline': await manager.is_user_online(another_uid) if another_uid else False,
+        'another_uid': another_uid,
+        'is_group': is_group,
+        'members_count': len(uids_set)
     }
     
     return result
 
-def get_current_user(request):
-    token = request.cookies.get("access_token")
-    if not token:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Not authenticated",
-        )
-    try:
-        payload = jwt.decode(token, SECRET_HASH, algorithms=["HS256"])
-        user_id = payload.get("userId")
-        if user_id is None:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Could not validate credentials",
-            )
-        return user_id
-    except jwt.PyJWTError:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Could not validate credentials",
-        )
-        
+@router.get("/search")
+async def search(
+    q: str = Query(..., min_length=1, max_length=256),
+    chat_id: Optional[int] = None,
+    limit: int = Query(SEARCH_PAGE_SIZE, ge=1, le=SEARCH_MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0),
+    uid: int = Depends(get_current_uid),
+    session: AsyncSession = Depends(get_async_session),
+):
+    """
+    Endpoint to search messages in chats of user, most relevant first
+
+    Args:
+        q (str): search query, supports "quoted phrases", or and -excluded words
+        chat_id (int, optional): search only this chat; all chats of user if None
+        limit (int, optional): max number of messages in page
+        offset (int, optional): number of messages to skip
+        uid (int, optional): id of authenticated user
+        session (AsyncSession, optional): connection to database
+
+    Returns:
+        dict: page of found messages with highlighted snippets and offset of next page
+    """
+    msgs = await msgService.searchMessages(session, uid, q, chat_id, limit + 1, offset)
+    has_more = len(msgs) > limit
+    return {
+        'messages': msgs[:limit],
+        'next_offset': offset + limit if has_more else None
+    }
+
+
+async def mark_read(user_id: int, chat_id: int, message_id: int, session: AsyncSession):
+    """
+    Move read marker of user and push read receipt to members of chat
+
+    Args:
+        user_id (int): id of reader
+        chat_id (int): chat id
+        message_id (int): id of the newest message read
+        session (AsyncSession): connection to database
+    """
+    members = await cache.get_chat_members(session, chat_id)
+    if user_id not in members:
+        return
+    # marker is clamped to the last message, with write-behind it may be queued and not in db yet
+    read = await chatMmbrService.markChatRead(
+        session, chat_id, user_id, message_id, message_writer.newestId() if MESSAGE_WRITE_BEHIND else None
+    )
+    if read is None:
+        return
+    await unread.set_count(user_id, chat_id, read['unread_count'])
+    frame = Frame({'type': 'read', 'chat_id': chat_id, 'user_id': user_id, 'message_id': read['message_id']})
+    await manager.fanout(list(members) if len(members) <= READ_RECEIPTS_MAX_MEMBERS else [user_id], frame)
+
+
+async def send_message(user_id: int, data: dict, session: AsyncSession):
+    """
+    Persist message sent over WebSocket and deliver it to members of chat
+
+    Args:
+        user_id (int): sender id
+        data (dict): frame with chat_id and content
+        session (AsyncSession): connection to database
+    """
+    now_utc = datetime.now(timezone.utc)
+    now_naive = now_utc.replace(tzinfo=None)
+    receps = await cache.get_chat_members(session, data['chat_id'])
+    if user_id not in receps:
+        return
+    if MESSAGE_WRITE_BEHIND:
+        message_id = await message_writer.addMessage(data['chat_id'], user_id, data['content'], now_naive)
+    else:
+        message_id = await msgService.addMessage(data['chat_id'], user_id, data['content'], now_naive, session)
+    await cache.append_chat_history(data['chat_id'], {
+        'message_id': message_id,
+        'chat_id': data['chat_id'],
+        'sender_id': user_id,
+        'text': data['content'],
+        'time': now_naive.isoformat()
+    }, pending=MESSAGE_WRITE_BEHIND)
+    if not MESSAGE_WRITE_BEHIND:
+        # with write-behind, sidebars are invalidated by messages_flushed once the message is in db
+        await cache.invalidate_user_chats(*receps)
+    await unread.increment(data['chat_id'], [recep for recep in receps if recep != user_id])
+    frame = Frame({
+        'type': 'message',
+        'message_id': message_id,
+        'chat_id': data['chat_id'],
+        'sender_id': user_id,
+        'content': data['content'],
+        'time': now_utc.isoformat()
+    })
+    recipients = list(receps)
+    online = await manager.fanout(recipients, frame)
+    offline = [recep for recep in recipients if recep not in online]
+    if offline:
+        await manager.notify_offline(offline, frame.payload, session)
+
+
+async def messages_flushed(rows: list):
+    """
+    Called by the write-behind writer after a batch was written: lets history lists of
+    the chats be warmed again and drops sidebars of their members cached without the batch
+
+    Args:
+        rows (list): written messages
+    """
+    counts = {}
+    for row in rows:
+        counts[row['chat_id']] = counts.get(row['chat_id'], 0) + 1
+    await cache.chat_history_flushed(counts)
+    members = set()
+    async with async_session_maker() as session:
+        for chat_id in counts:
+            members |= await cache.get_chat_members(session, chat_id)
+    await cache.invalidate_user_chats(*members)
+
+
+@router.get("/stats")
+async def stats(uid: int = Depends(get_current_uid)):
+    """
+    Endpoint to get load of this worker
+
+    Args:
+        uid (int, optional): id of authenticated user
+
+    Returns:
+        dict: counters of WebSocket connections and utilization of db connection pools
+    """
+    return {'connections': manager.stats(), 'db_pool': poolStats()}
+
 
 @router.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket, session: AsyncSession = Depends(get_async_session)):
+async def websocket_endpoint(
+    websocket: WebSocket,
+    user_id: int = Depends(get_current_uid)
+):
     """
     Endpoint to exchange messages
 
+    A connection to db is taken from the pool for one frame at a time, so idle
+    sockets don't hold any.
+
     Args:
         websocket (WebSocket): websocket connection
-        session (AsyncSession, optional): connection to database
+        user_id (int, optional): id of authenticated user
     """
-    user_id = get_current_user(websocket)
-    await manager.connect(user_id, websocket)
+    connection = await manager.connect(user_id, websocket)
     
     try:
         while True:
             data = await websocket.receive_json()
-            now_utc = datetime.now(timezone.utc)
-            now_naive = now_utc.replace(tzinfo=None)
-            message_id = await msgService.addMessage(data['chat_id'], user_id, data['content'], now_naive, session)
-            receps = await chatMmbrService.getChatMembersByChatId(session, data['chat_id'])
-            cache_key = f"chat_history:{data['chat_id']}"
-            redis_client.delete(cache_key)
-            for recep in receps:
-                await manager.send_message(recep['user_id'], {**data, 'isMyMessage': user_id == recep['user_id'], 'message_id': message_id, 'sender_id': user_id, 'time': datetime.now(timezone.utc).isoformat()}, session)
+            connection.touch()
+            WS_FRAME_TYPES.get(data.get('type'), WS_FRAME_TYPES['message']).inc()
+            if data.get('type') == 'pong':
+                continue
+            if data.get('type') == 'read':
+                chat_id, message_id = data.get('chat_id'), data.get('message_id')
+                # a malformed frame is dropped instead of failing the query and closing the socket
+                if type(chat_id) is not int or type(message_id) is not int:
+                    continue
+                async with async_session_maker() as session:
+                    await mark_read(user_id, chat_id, message_id, session)
+                continue
+            async with async_session_maker() as session:
+                await send_message(user_id, data, session)
 
     except WebSocketDisconnect:
-        manager.disconnect(user_id)
+        pass
+    finally:
+        await manager.disconnect(user_id, connection)
         # await manager.broadcast(f"{user_id} left the chat")
\ No newline at end of file
@@ -1,40 +1,351 @@
-from fastapi import WebSocket
-from typing import Dict
+from fastapi import WebSocket, status
+from typing import Dict, Iterable, List, Set
 from src.db.services import usrService
 from src.db.config import *
 from src.db.models import User
 from sqlalchemy.ext.asyncio import AsyncSession
 from src.bot.celery_app import *
+from src.api import cache, notifications
+from src.api.presence import Presence, PRESENCE_CHANNEL
+from src.api.protocol import Frame, PING, negotiate
+from src.metrics import FANOUT_DURATION, WS_FRAMES_OUT
+from typing import Optional
+from src.db.db import async_session_maker
+from src.api.cache import redis_client
+import asyncio
+import orjson
+import logging
+import time
+import uuid
 
 
+logger = logging.getLogger(__name__)
+
+WORKER_CHANNEL = "ws:worker:{}"
+BROADCAST_CHANNEL = "ws:broadcast"
+# Closes of slow consumers started from send, referenced until done so they aren't collected
+closing_tasks = set()
+
+
+class Connection:
+    """
+    WebSocket with a bounded outbound queue drained by its own writer task,
+    so a slow client never blocks delivery to other clients
+    """
+    def __init__(
+        self,
+        websocket: WebSocket,
+        user_id: int,
+        protocol: Optional[str] = None,
+        queue_size: int = WS_SEND_QUEUE_SIZE,
+        overflow_policy: str = WS_OVERFLOW_POLICY
+    ):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.protocol = protocol
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.overflow_policy = overflow_policy
+        self.writer = asyncio.create_task(self._write())
+        self.closed = False
+        self.last_seen = time.monotonic()
+
+    def touch(self):
+        """
+        Record that a frame was received from the client
+        """
+        self.last_seen = time.monotonic()
+
+    def send(self, frame: Frame):
+        """
+        Queue frame for sending without waiting for the client
+
+        Args:
+            frame (Frame): frame to send
+        """
+        if self.closed:
+            return
+        try:
+            self.queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            if self.overflow_policy == "disconnect":
+                logger.warning("Closing slow WebSocket consumer")
+                self.closed = True
+                self.writer.cancel()
+                task = asyncio.create_task(self._close_socket(status.WS_1013_TRY_AGAIN_LATER))
+                closing_tasks.add(task)
+                task.add_done_callback(closing_tasks.discard)
+                return
+            self.queue.get_nowait()
+            self.queue.put_nowait(frame)
+
+    async def _write(self):
+        try:
+            while True:
+                frame = await self.queue.get()
+                await self.websocket.send_text(frame.encode(self.protocol, self.user_id))
+                WS_FRAMES_OUT.inc()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.closed = True
+
+    async def close(self, code: int = status.WS_1000_NORMAL_CLOSURE):
+        """
+        Stop writer task and close the socket
+
+        Args:
+            code (int, optional): WebSocket close code
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.writer.cancel()
+        await self._close_socket(code)
+
+    async def _close_socket(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+    def stop(self):
+        """
+        Stop writer task of a connection closed by the client
+        """
+        self.closed = True
+        self.writer.cancel()
+
 
 class ConnectionManager:
+    """
+    Keeps WebSocket connections of this worker and delivers messages to
+    users connected to other workers through Redis pub/sub.
+
+    A user may have several connections (tabs, devices) on any workers. A message
+    is sent to local connections directly and routed by presence to the others:
+    one publish on the channel of every worker holding connections of some of
+    the recipients, carrying the list of recipients on that worker.
+    Changes of presence are pushed to connected users having a private chat
+    with the user.
+    """
     def __init__(self):
-        self.active_connections: Dict[int, WebSocket] = {}
+        self.active_connections: Dict[int, Set[Connection]] = {}
+        self.worker_id = uuid.uuid4().hex
+        self.redis = redis_client
+        self.presence = Presence(self.worker_id)
+        self.pubsub = None
+        self.listener = None
+        self.heartbeat = None
+        self.reaper = None
+        self.reaped_connections = 0
+        # Pushes of presence changes, run beside the listener since resolving contacts may wait for db
+        self.presence_pushes: Set[asyncio.Task] = set()
+
+    async def start(self):
+        """
+        Subscribe to the broadcast, presence and cache invalidation channels, start listening
+        for messages published by other workers and refreshing presence of local users
+        """
+        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        await self.pubsub.subscribe(
+            BROADCAST_CHANNEL,
+            PRESENCE_CHANNEL,
+            cache.INVALIDATE_CHANNEL,
+            WORKER_CHANNEL.format(self.worker_id)
+        )
+        self.listener = asyncio.create_task(self._listen())
+        self.heartbeat = asyncio.create_task(self._heartbeat())
+        self.reaper = asyncio.create_task(self._reap())
+
+    async def stop(self):
+        """
+        Stop listening, drop presence of users connected to this worker and announce
+        offline those not connected elsewhere
+        """
+        for task in (self.listener, self.heartbeat, self.reaper, *self.presence_pushes):
+            if task:
+                task.cancel()
+        await self.presence.remove(list(self.active_connections))
+        if self.pubsub:
+            await self.pubsub.aclose()
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(PRESENCE_HEARTBEAT)
+            try:
+                await self.presence.refresh(list(self.active_connections))
+                await self.presence.sweep()
+            except Exception as e:
+                logger.exception(f"Presence heartbeat failed: {e}")
 
-    async def connect(self, user_id: int, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections[user_id] = websocket
+    async def _reap(self):
+        while True:
+            await asyncio.sleep(WS_PING_INTERVAL)
+            deadline = time.monotonic() - WS_PING_TIMEOUT
+            stale = []
+            for user_id, connections in list(self.active_connections.items()):
+                for connection in list(connections):
+                    if connection.last_seen >= deadline:
+                        connection.send(PING)
+                    else:
+                        stale.append((user_id, connection))
+            # half-open sockets may wait out the close timeout, don't let them hold up each other
+            await asyncio.gather(*(self._reap_connection(user_id, connection) for user_id, connection in stale))
 
-    def disconnect(self, user_id: int):
-        del self.active_connections[user_id]
+    async def _reap_connection(self, user_id: int, connection: Connection):
+        try:
+            await connection.close(code=status.WS_1001_GOING_AWAY)
+            await self.disconnect(user_id, connection)
+            self.reaped_connections += 1
+        except Exception as e:
+            logger.exception(f"Failed to reap connection of user {user_id}: {e}")
 
-    async def send_message(self, user_id: int, message: dict, session: AsyncSession):
-        if self.is_user_online(user_id):
-            websocket = self.active_connections[user_id]
-            await websocket.send_json(message)
-        else:
-            usr = await usrService.userGetById(user_id, session)
-            sender = await usrService.userGetById(message['sender_id'], session)
-            if usr['tg_id']:
-                send_message_task.delay(usr['tg_id'], message, sender['nickname'])
+    def stats(self) -> dict:
+        """
+        Counters of connections of this worker
+
+        Returns:
+            dict: number of live connections, connected users and connections closed for inactivity
+        """
+        return {
+            'live_connections': sum(len(connections) for connections in self.active_connections.values()),
+            'connected_users': len(self.active_connections),
+            'reaped_connections': self.reaped_connections,
+        }
+
+    async def _listen(self):
+        while True:
+            try:
+                async for item in self.pubsub.listen():
+                    await self._deliver(item['channel'].decode(), orjson.loads(item['data']))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"Pub/sub listener failed: {e}")
+                await asyncio.sleep(1)
+
+    async def _deliver(self, channel: str, message: dict):
+        if channel == cache.INVALIDATE_CHANNEL:
+            cache.handle_invalidation(message)
+            return
+        if channel == PRESENCE_CHANNEL:
+            if self.active_connections:
+                task = asyncio.create_task(self._push_presence(message['user_id'], message['online']))
+                self.presence_pushes.add(task)
+                task.add_done_callback(self.presence_pushes.discard)
+            return
+        if channel == BROADCAST_CHANNEL:
+            frame = Frame(message)
+            for connections in self.active_connections.values():
+                for connection in connections:
+                    connection.send(frame)
+            return
+        if message['origin'] == self.worker_id:
+            return
+        frame = Frame(message['message'])
+        for user_id in message['recipients']:
+            for connection in self.active_connections.get(user_id, ()):
+                connection.send(frame)
+
+    async def _push_presence(self, user_id: int, online: bool):
+        try:
+            async with async_session_maker() as session:
+                contacts = await cache.get_user_contacts(session, user_id)
+        except Exception as e:
+            logger.warning(f"Failed to push presence of user {user_id}: {e}")
+            return
+        frame = Frame({'type': 'presence', 'user_id': user_id, 'online': online})
+        for contact in contacts:
+            for connection in self.active_connections.get(contact, ()):
+                connection.send(frame)
+
+    async def connect(self, user_id: int, websocket: WebSocket) -> Connection:
+        protocol = negotiate(websocket)
+        await websocket.accept(subprotocol=protocol)
+        connection = Connection(websocket, user_id, protocol)
+        connection.send(Frame({'type': 'hello', 'uid': user_id}))
+        connections = self.active_connections.setdefault(user_id, set())
+        connections.add(connection)
+        if len(connections) == 1:
+            await self.presence.user_connected(user_id)
+        return connection
+
+    async def disconnect(self, user_id: int, connection: Connection):
+        connection.stop()
+        connections = self.active_connections.get(user_id, set())
+        if connection not in connections:
+            return
+        connections.discard(connection)
+        if connections:
+            return
+        self.active_connections.pop(user_id, None)
+        await self.presence.user_disconnected(user_id)
+
+    async def fanout(self, user_ids: List[int], frame: Frame) -> Set[int]:
+        """
+        Send frame to every connection of several users, publishing it once per
+        worker holding connections of some of them
+
+        Args:
+            user_ids (List[int]): recipient ids
+            frame (Frame): frame to send
+
+        Returns:
+            Set[int]: ids of recipients connected to some worker
+        """
+        with FANOUT_DURATION.time():
+            return await self._fanout(user_ids, frame)
+
+    async def _fanout(self, user_ids: List[int], frame: Frame) -> Set[int]:
+        online = set()
+        for user_id in user_ids:
+            for connection in self.active_connections.get(user_id, ()):
+                connection.send(frame)
+                online.add(user_id)
+
+        by_worker = {}
+        for user_id, workers in (await self.presence.workers(user_ids)).items():
+            for worker in workers:
+                if worker != self.worker_id:
+                    by_worker.setdefault(worker, []).append(user_id)
+        if not by_worker:
+            return online
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for worker, recipients in by_worker.items():
+                pipe.publish(
+                    WORKER_CHANNEL.format(worker),
+                    f'{{"origin": "{self.worker_id}", "recipients": {orjson.dumps(recipients).decode()}, "message": {frame.json}}}'
+                )
+            receivers = await pipe.execute()
+        for recipients, received in zip(by_worker.values(), receivers):
+            if received:
+                online.update(recipients)
+        return online
+
+    async def notify_offline(self, user_ids: Iterable[int], message: dict, session: AsyncSession):
+        """
+        Queue telegram notifications about message to offline users
+
+        Profiles of all recipients are read with one query on cache miss and
+        notifications are queued with one Redis round trip.
+
+        Args:
+            user_ids (Iterable[int]): recipient ids
+            message (dict): message to notify about
+            session (AsyncSession): connection to db
+        """
+        user_ids = list(user_ids)
+        profiles = await cache.get_user_profiles(session, [*user_ids, message['sender_id']])
+        sender = profiles.get(message['sender_id'])
+        tg_ids = [profiles[user_id]['tg_id'] for user_id in user_ids if profiles.get(user_id, {}).get('tg_id')]
+        if sender and tg_ids:
+            await notifications.notify_many(tg_ids, message['chat_id'], sender['nickname'], message)
 
     async def broadcast(self, message: dict):
-        for connection in self.active_connections.values():
-            await connection.send_json(message)
-
-    def get_connection(self, user_id: int) -> WebSocket:
-        return self.active_connections.get(user_id)
-    
-    def is_user_online(self, user_id: int):
-        return user_id in self.active_connections
\ No newline at end of file
+        await self.redis.publish(BROADCAST_CHANNEL, orjson.dumps(message))
+
+    async def is_user_online(self, user_id: int):
+        if user_id in self.active_connections:
+            return True
+        return await self.presence.is_online(user_id)
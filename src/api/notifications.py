@@ -0,0 +1,49 @@
+from src.api.cache import redis_client
+from src.bot.celery_app import send_digest_task, NOTIFY_QUEUE_KEY, NOTIFY_PENDING_KEY
+from src.db.config import NOTIFY_WINDOW
+from src.metrics import NOTIFICATIONS
+from typing import List
+import asyncio
+import json
+
+"""
+    Coalescing of Telegram notifications for offline users
+"""
+
+
+async def notify_many(tg_ids: List[int], chat_id: int, sender_nick: str, message: dict):
+    """
+    Queue notifications about message for several recipients with one Redis round trip
+
+    Args:
+        tg_ids (List[int]): telegram chat ids of recipients
+        chat_id (int): chat id where message was sent
+        sender_nick (str): nickname of sender
+        message (dict): message with content and time
+    """
+    item = json.dumps({'sender': sender_nick, 'content': message['content'], 'time': message['time']})
+    async with redis_client.pipeline(transaction=True) as pipe:
+        for tg_id in tg_ids:
+            queue_key = NOTIFY_QUEUE_KEY.format(tg_id, chat_id)
+            pipe.rpush(queue_key, item)
+            pipe.expire(queue_key, 24 * 3600)
+            pipe.set(NOTIFY_PENDING_KEY.format(tg_id, chat_id), 1, nx=True, ex=24 * 3600)
+        results = await pipe.execute()
+    NOTIFICATIONS.labels("queued").inc(len(tg_ids))
+    scheduled = [tg_id for tg_id, first in zip(tg_ids, results[2::3]) if first]
+    if scheduled:
+        # publishing to the broker blocks, keep it off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, schedule_digests, scheduled, chat_id)
+
+
+def schedule_digests(tg_ids: List[int], chat_id: int):
+    """
+    Send digest tasks of chat for recipients to Celery, due at the end of the window
+
+    Args:
+        tg_ids (List[int]): telegram chat ids of recipients
+        chat_id (int): chat id where messages were sent
+    """
+    for tg_id in tg_ids:
+        send_digest_task.apply_async((tg_id, chat_id), countdown=NOTIFY_WINDOW)
+        NOTIFICATIONS.labels("digest_enqueued").inc()
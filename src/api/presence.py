@@ -0,0 +1,180 @@
+from src.api.cache import redis_client
+from src.db.config import PRESENCE_TTL, PRESENCE_DEBOUNCE
+from typing import Dict, Iterable, List
+import asyncio
+import json
+import time
+
+"""
+    Presence of users shared by all workers
+"""
+
+PRESENCE_KEY = "presence:{}"
+ANNOUNCED_KEY = "presence_announced:{}"
+PRESENCE_CHANNEL = "presence"
+# Users scored by the latest expiry of their presence entries, swept by heartbeats once expired
+EXPIRY_KEY = "presence_expiry"
+SWEEP_BATCH = 1000
+
+# Pops up to ARGV[2] users of KEYS[1] whose presence expired by ARGV[1]
+SWEEP = redis_client.register_script("""
+local user_ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+if #user_ids > 0 then
+    redis.call('ZREM', KEYS[1], unpack(user_ids))
+end
+return user_ids
+""")
+
+# Records user offline in KEYS[2] unless presence KEYS[1] has an entry live at ARGV[1],
+# returns 1 if the user was announced online before
+SET_OFFLINE = redis_client.register_script("""
+if redis.call('ZCOUNT', KEYS[1], ARGV[1], '+inf') > 0 then
+    return 0
+end
+if redis.call('GETSET', KEYS[2], 0) == '0' then
+    return 0
+end
+return 1
+""")
+
+
+class Presence:
+    """
+    Online status of users kept in Redis and announced on PRESENCE_CHANNEL.
+
+    Every user has a sorted set of workers holding their connections, scored by
+    the time the entry expires. Workers refresh entries of their users with
+    heartbeats, so users of a crashed worker go offline after PRESENCE_TTL and
+    are announced offline by the heartbeat sweep of any other worker.
+    The last announced status is stored next to it: a change is published only
+    when it differs, and going offline is checked again after PRESENCE_DEBOUNCE
+    seconds, so a quickly reconnecting client produces no events.
+    """
+    def __init__(self, worker_id: str):
+        self.worker_id = worker_id
+        self.pending = {}
+
+    async def user_connected(self, user_id: int):
+        """
+        Mark user as connected to this worker, announce if they were offline
+
+        Args:
+            user_id (int): user id
+        """
+        pending = self.pending.pop(user_id, None)
+        if pending:
+            pending.cancel()
+        await self.refresh([user_id])
+        await self._announce(user_id, True)
+
+    async def user_disconnected(self, user_id: int):
+        """
+        Drop this worker from presence of user, announce offline after debounce
+
+        Args:
+            user_id (int): user id
+        """
+        await redis_client.zrem(PRESENCE_KEY.format(user_id), self.worker_id)
+        if user_id not in self.pending:
+            self.pending[user_id] = asyncio.create_task(self._announce_offline_later(user_id))
+
+    async def refresh(self, user_ids: Iterable[int]):
+        """
+        Extend presence entries of this worker for connected users
+
+        Args:
+            user_ids (Iterable[int]): ids of users connected to this worker
+        """
+        expires = time.time() + PRESENCE_TTL
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.zadd(PRESENCE_KEY.format(user_id), {self.worker_id: expires})
+                pipe.expire(PRESENCE_KEY.format(user_id), int(PRESENCE_TTL) + 1)
+                pipe.zadd(EXPIRY_KEY, {user_id: expires}, gt=True)
+            await pipe.execute()
+
+    async def remove(self, user_ids: Iterable[int]):
+        """
+        Drop presence entries of this worker and announce offline users not connected
+        to other workers, used on shutdown. Pending debounced announcements are made now.
+
+        Args:
+            user_ids (Iterable[int]): ids of users connected to this worker
+        """
+        user_ids = set(user_ids)
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.zrem(PRESENCE_KEY.format(user_id), self.worker_id)
+            await pipe.execute()
+        for user_id, pending in list(self.pending.items()):
+            pending.cancel()
+            user_ids.add(user_id)
+        for user_id in user_ids:
+            await self._announce_offline(user_id)
+
+    async def sweep(self) -> int:
+        """
+        Announce offline users whose presence entries expired, as those of a crashed worker
+
+        Returns:
+            int: number of users announced offline
+        """
+        announced = 0
+        while True:
+            user_ids = await SWEEP(keys=[EXPIRY_KEY], args=[time.time(), SWEEP_BATCH])
+            for user_id in user_ids:
+                announced += await self._announce_offline(int(user_id))
+            if len(user_ids) < SWEEP_BATCH:
+                return announced
+
+    async def is_online(self, user_id: int) -> bool:
+        """
+        Check if some worker holds a live connection of user
+
+        Args:
+            user_id (int): user id
+
+        Returns:
+            bool: True if online
+        """
+        return await redis_client.zcount(PRESENCE_KEY.format(user_id), time.time(), "+inf") > 0
+
+    async def workers(self, user_ids: List[int]) -> Dict[int, List[str]]:
+        """
+        Find workers holding live connections of several users with one round trip
+
+        Args:
+            user_ids (List[int]): user ids
+
+        Returns:
+            Dict[int, List[str]]: ids of workers for every online user, offline users are skipped
+        """
+        now = time.time()
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.zrangebyscore(PRESENCE_KEY.format(user_id), now, "+inf")
+            results = await pipe.execute()
+        return {
+            user_id: [worker.decode() for worker in workers]
+            for user_id, workers in zip(user_ids, results)
+            if workers
+        }
+
+    async def _announce_offline_later(self, user_id: int):
+        try:
+            await asyncio.sleep(PRESENCE_DEBOUNCE)
+            await self._announce_offline(user_id)
+        finally:
+            if self.pending.get(user_id) is asyncio.current_task():
+                del self.pending[user_id]
+
+    async def _announce_offline(self, user_id: int) -> bool:
+        if await SET_OFFLINE(keys=[PRESENCE_KEY.format(user_id), ANNOUNCED_KEY.format(user_id)], args=[time.time()]):
+            await redis_client.publish(PRESENCE_CHANNEL, json.dumps({'user_id': user_id, 'online': False}))
+            return True
+        return False
+
+    async def _announce(self, user_id: int, online: bool):
+        previous = await redis_client.getset(ANNOUNCED_KEY.format(user_id), int(online))
+        if previous is None or bool(int(previous)) != online:
+            await redis_client.publish(PRESENCE_CHANNEL, json.dumps({'user_id': user_id, 'online': online}))
@@ -0,0 +1,108 @@
+from fastapi import WebSocket
+from datetime import datetime
+from typing import Optional
+import orjson
+
+"""
+    Wire protocols of /ws, negotiated with the Sec-WebSocket-Protocol header
+"""
+
+# Original frames: JSON objects with full key names, ISO time and per-recipient isMyMessage
+JSON_PROTOCOL = "chat.json.v1"
+# Short keys, epoch milliseconds, no per-recipient fields: clients compare sender with uid from hello frame
+COMPACT_PROTOCOL = "chat.compact.v1"
+# Server preference order
+SUPPORTED_PROTOCOLS = (COMPACT_PROTOCOL, JSON_PROTOCOL)
+
+
+def negotiate(websocket: WebSocket) -> Optional[str]:
+    """
+    Choose protocol among the ones offered by client
+
+    Args:
+        websocket (WebSocket): websocket connection before accept
+
+    Returns:
+        str or None: chosen subprotocol, None if client offered none (original JSON frames are used)
+    """
+    offered = websocket.scope.get("subprotocols", [])
+    for protocol in SUPPORTED_PROTOCOLS:
+        if protocol in offered:
+            return protocol
+    return None
+
+
+def _epoch_ms(iso_time: str) -> int:
+    return int(datetime.fromisoformat(iso_time).timestamp() * 1000)
+
+
+def _compact(payload: dict) -> dict:
+    kind = payload.get("type")
+    if kind == "message":
+        return {
+            "t": "m",
+            "i": payload["message_id"],
+            "c": payload["chat_id"],
+            "s": payload["sender_id"],
+            "x": payload["content"],
+            "ts": _epoch_ms(payload["time"]),
+        }
+    if kind == "presence":
+        return {"t": "s", "u": payload["user_id"], "o": int(payload["online"])}
+    if kind == "read":
+        return {"t": "r", "c": payload["chat_id"], "u": payload["user_id"], "i": payload["message_id"]}
+    if kind == "ping":
+        return {"t": "p"}
+    if kind == "hello":
+        return {"t": "h", "u": payload["uid"]}
+    return payload
+
+
+class Frame:
+    """
+    Outgoing frame shared by all recipients and encoded at most once per protocol.
+
+    Only message frames of the JSON protocol depend on the recipient
+    (isMyMessage), so they are encoded at most twice: for the sender and
+    for everyone else.
+    """
+    def __init__(self, payload: dict):
+        self.payload = payload
+        self.encoded = {}
+
+    @property
+    def json(self) -> str:
+        """
+        Payload as JSON, used to publish frame to other workers
+        """
+        if "json" not in self.encoded:
+            self.encoded["json"] = orjson.dumps(self.payload).decode()
+        return self.encoded["json"]
+
+    def encode(self, protocol: Optional[str], user_id: int) -> str:
+        """
+        Encode frame for connection
+
+        Args:
+            protocol (str or None): protocol of connection
+            user_id (int): id of user owning connection
+
+        Returns:
+            str: text of WebSocket frame
+        """
+        if protocol == COMPACT_PROTOCOL:
+            key = protocol
+        elif self.payload.get("type") == "message":
+            key = (JSON_PROTOCOL, self.payload["sender_id"] == user_id)
+        else:
+            return self.json
+
+        if key not in self.encoded:
+            if protocol == COMPACT_PROTOCOL:
+                self.encoded[key] = orjson.dumps(_compact(self.payload)).decode()
+            else:
+                self.encoded[key] = orjson.dumps({**self.payload, "isMyMessage": key[1]}).decode()
+        return self.encoded[key]
+
+
+PING = Frame({"type": "ping"})
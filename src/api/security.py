@@ -0,0 +1,109 @@
+from fastapi import HTTPException, WebSocketException, status
+from fastapi.requests import HTTPConnection
+from datetime import datetime, timedelta, timezone
+from src.api.cache import LRUCache, read_your_writes_until
+from src.db.config import SECRET_HASH, SECRET_HASH_PREVIOUS, JWT_CACHE_SIZE, JWT_CACHE_TTL
+from src.db.db import current_user, sticky_until
+import hashlib
+import jwt
+import time
+
+"""
+    JWT issuing and verification shared by all routers
+"""
+
+TOKEN_COOKIE = "access_token"
+TOKEN_LIFETIME = timedelta(minutes=1440)
+
+
+def key_id(key: str) -> str:
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+signing_keys = {key_id(key): key for key in [SECRET_HASH, *SECRET_HASH_PREVIOUS] if key}
+verified_tokens = LRUCache(maxsize=JWT_CACHE_SIZE, ttl=JWT_CACHE_TTL)
+
+
+def create_access_token(uid: int, login: str, nickname: str) -> str:
+    """
+    Issue JWT signed with the current key
+
+    Args:
+        uid (int): user id
+        login (str): login of user
+        nickname (str): nickname of user
+
+    Returns:
+        str: encoded token
+    """
+    claims = {"sub": login, "userId": uid, "nick": nickname, "exp": datetime.now(timezone.utc) + TOKEN_LIFETIME}
+    return jwt.encode(claims, SECRET_HASH, algorithm="HS256", headers={"kid": key_id(SECRET_HASH)})
+
+
+def verify_token(token: str) -> dict:
+    """
+    Verify JWT and return its claims, cached by token digest until the token expires
+
+    Tokens are checked with the key named by their `kid` header, or with every
+    known key for tokens issued before keys got ids.
+
+    Args:
+        token (str): encoded token
+
+    Raises:
+        jwt.InvalidTokenError: if token is expired, malformed or signed with unknown key
+
+    Returns:
+        dict: claims of token
+    """
+    digest = hashlib.sha256(token.encode()).digest()
+    claims = verified_tokens.get(digest)
+    if claims is not LRUCache.MISSING:
+        return claims
+
+    kid = jwt.get_unverified_header(token).get("kid")
+    keys = [signing_keys[kid]] if kid in signing_keys else list(signing_keys.values())
+    for key in keys:
+        try:
+            claims = jwt.decode(token, key, algorithms=["HS256"])
+            break
+        except jwt.InvalidSignatureError:
+            continue
+    else:
+        raise jwt.InvalidSignatureError("Signature verification failed")
+
+    ttl = claims["exp"] - time.time() if "exp" in claims else None
+    verified_tokens.set(digest, claims, ttl if ttl is None else min(ttl, JWT_CACHE_TTL))
+    return claims
+
+
+async def get_current_uid(connection: HTTPConnection) -> int:
+    """
+    Dependency returning id of user authenticated by the token cookie.
+    Async, so the user and the end of their read-your-writes window are recorded
+    for routing database reads of the request.
+
+    Args:
+        connection (HTTPConnection): request or websocket
+
+    Raises:
+        HTTPException: 401 for requests without valid token
+        WebSocketException: policy violation for websockets without valid token
+
+    Returns:
+        int: user id
+    """
+    token = connection.cookies.get(TOKEN_COOKIE)
+    try:
+        if not token:
+            raise jwt.InvalidTokenError("Not authenticated")
+        uid = verify_token(token).get("userId")
+        if uid is None:
+            raise jwt.InvalidTokenError("Could not validate credentials")
+        current_user.set(uid)
+        sticky_until.set(await read_your_writes_until(uid))
+        return uid
+    except jwt.PyJWTError as e:
+        if connection.scope["type"] == "websocket":
+            raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason=str(e))
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=str(e))
@@ -0,0 +1,83 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.api.cache import redis_client, CACHE_TTL
+from src.db.services import chatMmbrService
+from typing import Dict, Iterable
+
+"""
+    Unread counters of users kept in Redis and reconciled from Postgres
+"""
+
+UNREAD_KEY = "unread:{}"
+# Field marking a hash loaded from db, hashes without it are partial and get reloaded
+WARM_FIELD = "_"
+
+# Increments field ARGV[1] of every warm hash in KEYS, cold hashes are left to the next reload
+INCREMENT = redis_client.register_script(f"""
+for _, key in ipairs(KEYS) do
+    if redis.call('HEXISTS', key, '{WARM_FIELD}') == 1 then
+        redis.call('HINCRBY', key, ARGV[1], 1)
+    end
+end
+return 0
+""")
+
+# Sets field ARGV[1] of hash KEYS[1] to ARGV[2] if the hash is warm
+SET_COUNT = redis_client.register_script(f"""
+if redis.call('HEXISTS', KEYS[1], '{WARM_FIELD}') == 1 then
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+end
+return 0
+""")
+
+
+async def increment(chat_id: int, user_ids: Iterable[int]):
+    """
+    Count new message of chat as unread for users
+
+    Args:
+        chat_id (int): chat id where message was sent
+        user_ids (Iterable[int]): ids of recipients, without sender
+    """
+    keys = [UNREAD_KEY.format(user_id) for user_id in user_ids]
+    if keys:
+        await INCREMENT(keys=keys, args=[chat_id])
+
+
+async def get_counts(session: AsyncSession, user_id: int) -> Dict[int, int]:
+    """
+    Get unread counters of user, counting them in db only when the hash is cold
+
+    Counters live for CACHE_TTL seconds after being loaded, so drift from
+    messages racing with the reload is bounded by it.
+
+    Args:
+        session (AsyncSession): connection to db used on cache miss
+        user_id (int): user id
+
+    Returns:
+        Dict[int, int]: chat id to number of unread messages
+    """
+    key = UNREAD_KEY.format(user_id)
+    cached = await redis_client.hgetall(key)
+    if WARM_FIELD.encode() in cached:
+        return {int(chat_id): int(count) for chat_id, count in cached.items() if chat_id != WARM_FIELD.encode()}
+
+    counts = await chatMmbrService.getUnreadCounts(session, user_id)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.delete(key)
+        pipe.hset(key, mapping={WARM_FIELD: 1, **counts})
+        pipe.expire(key, CACHE_TTL)
+        await pipe.execute()
+    return counts
+
+
+async def set_count(user_id: int, chat_id: int, count: int):
+    """
+    Replace counter of chat after user read it, if counters of user are warm
+
+    Args:
+        user_id (int): id of reader
+        chat_id (int): chat id
+        count (int): number of messages still unread
+    """
+    await SET_COUNT(keys=[UNREAD_KEY.format(user_id)], args=[chat_id, count])
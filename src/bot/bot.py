@@ -1,7 +1,7 @@
 from celery import Celery
 from aiogram import Bot
 from db.config import TGBOTTOKEN
-import asyncio
+from bot.worker import worker_loop
 
 celery_app = Celery('tasks', broker='redis://localhost:6379/1')
 
@@ -13,6 +13,6 @@ async def send_telegram_message(chat_id: int, text: str):
 @celery_app.task
 def send_message_task(chat_id: int, text: str):
     try:
-        asyncio.run(send_telegram_message(chat_id, text))
+        worker_loop.run(send_telegram_message(chat_id, text))
     except Exception as e:
         print(f"Ошибка при отправке сообщения: {e}")
\ No newline at end of file
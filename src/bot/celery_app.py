@@ -2,27 +2,79 @@ from celery import Celery
 from aiogram import Bot, types
 from aiogram.enums import ParseMode
 from celery import shared_task
+from celery.signals import worker_process_init, worker_process_shutdown, worker_shutdown
 import asyncio
 from datetime import datetime
 from aiogram import Dispatcher
 from db.config import *
 from aiogram import F
 from aiogram.filters import Command
+from bot.worker import worker_loop
+import json
+import redis
+import time
 
 bot = Bot(token=TGBOTTOKEN)
 dp = Dispatcher()
 app = Celery('tasks', broker=f"redis://{REDIS_HOST}:6379/1")
 app.autodiscover_tasks(['bot'])
+app.conf.beat_schedule = {
+    'maintain-message-partitions': {
+        'task': 'src.bot.celery_app.maintain_partitions_task',
+        'schedule': 6 * 3600,
+    },
+}
+redis_client = redis.Redis(host=REDIS_HOST, port=6379, db=0)
+
+NOTIFY_QUEUE_KEY = "notify:{}:{}"
+NOTIFY_PENDING_KEY = "notify_pending:{}:{}"
+NOTIFY_BUCKET_KEY = "notify_bucket:{}"
+NOTIFY_GLOBAL_BUCKET_KEY = "notify_bucket:global"
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Takes one token from every bucket in KEYS or none of them.
+# ARGV: now, then rate and capacity of every bucket. Returns seconds to wait, 0 if tokens were taken.
+TAKE_TOKENS = redis_client.register_script("""
+local now = tonumber(ARGV[1])
+local wait = 0
+local tokens = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i])
+    local capacity = tonumber(ARGV[2 * i + 1])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local available = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+    available = math.min(capacity, available + math.max(0, now - ts) * rate)
+    if available < 1 then
+        wait = math.max(wait, (1 - available) / rate)
+    end
+    tokens[i] = available
+end
+if wait > 0 then
+    return tostring(wait)
+end
+for i, key in ipairs(KEYS) do
+    redis.call('HSET', key, 'tokens', tokens[i] - 1, 'ts', now)
+    redis.call('EXPIRE', key, 3600)
+end
+return '0'
+""")
 
 
 def run_async(coro):
-    """Runs an asynchronous routine in a synchronous context"""
-    loop = asyncio.get_event_loop()
-    if loop.is_running():
-        future = asyncio.run_coroutine_threadsafe(coro, loop)
-        return future.result()
-    else:
-        return loop.run_until_complete(coro)
+    """Runs an asynchronous routine on the event loop of the worker process"""
+    return worker_loop.run(coro)
+
+
+@worker_process_init.connect
+def start_worker_loop(**kwargs):
+    worker_loop.start()
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def stop_worker_loop(**kwargs):
+    worker_loop.stop(bot.session.close())
 
 @shared_task
 def send_message_task(chat_id, message, sender_nick):
@@ -35,6 +87,65 @@ def send_message_task(chat_id, message, sender_nick):
     except Exception as e:
         print(f"Failed to send message to {chat_id}: {e}")
         
+def format_digest(items: list) -> str:
+    """
+    Build one notification text from queued messages of a chat
+
+    Args:
+        items (list): dicts with sender, content and time of messages, oldest first
+
+    Returns:
+        str: text of notification, cut to the Telegram message limit
+    """
+    if len(items) == 1:
+        item = items[0]
+        formatted_date = datetime.fromisoformat(item['time']).strftime("%d-%m-%Y %H:%M")
+        return f"Sender: {item['sender']}\nMessage: {item['content']}\nDate: {formatted_date}"
+    lines = [f"{len(items)} new messages:"]
+    for item in items:
+        formatted_date = datetime.fromisoformat(item['time']).strftime("%d-%m-%Y %H:%M")
+        lines.append(f"[{formatted_date}] {item['sender']}: {item['content']}")
+    text = "\n".join(lines)
+    return text if len(text) <= TELEGRAM_MESSAGE_LIMIT else text[:TELEGRAM_MESSAGE_LIMIT - 1] + "…"
+
+
+@shared_task(bind=True, max_retries=None)
+def send_digest_task(self, tg_id, chat_id):
+    """
+    Send one notification with all messages queued for recipient in chat during the window
+    """
+    wait = float(TAKE_TOKENS(
+        keys=[NOTIFY_BUCKET_KEY.format(tg_id), NOTIFY_GLOBAL_BUCKET_KEY],
+        args=[time.time(), NOTIFY_CHAT_RATE, NOTIFY_CHAT_RATE, NOTIFY_GLOBAL_RATE, NOTIFY_GLOBAL_RATE]
+    ))
+    if wait > 0:
+        raise self.retry(countdown=wait)
+
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.lrange(NOTIFY_QUEUE_KEY.format(tg_id, chat_id), 0, -1)
+    pipe.delete(NOTIFY_QUEUE_KEY.format(tg_id, chat_id))
+    pipe.delete(NOTIFY_PENDING_KEY.format(tg_id, chat_id))
+    items = [json.loads(item) for item in pipe.execute()[0]]
+    if not items:
+        return
+    try:
+        run_async(bot.send_message(tg_id, format_digest(items)))
+    except Exception as e:
+        print(f"Failed to send message to {tg_id}: {e}")
+
+
+@shared_task
+def maintain_partitions_task():
+    """
+    Create upcoming monthly partitions of messages and archive old ones
+    """
+    from src.db import partitions
+
+    archived = run_async(partitions.maintainPartitions())
+    if archived:
+        print(f"Archived partitions: {', '.join(archived)}")
+
+
 @dp.message(Command("start"))
 async def start_command(message: types.Message):
     await message.answer(
@@ -0,0 +1,72 @@
+import asyncio
+import threading
+
+"""
+    Event loop living for the whole lifetime of a Celery worker process
+"""
+
+
+class WorkerLoop:
+    """
+    Runs one event loop in a background thread of the worker process.
+
+    Tasks submit coroutines to it instead of creating a loop per task, so
+    objects bound to the loop (aiohttp sessions of the bot, keep-alive
+    connections to Telegram) are created once and reused by every task.
+    Works with both prefork and thread pools.
+    """
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the loop thread, replacing one inherited from a parent process
+        """
+        with self.lock:
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.loop.run_forever, name="worker-loop", daemon=True)
+            self.thread.start()
+
+    def run(self, coro, timeout: float = None):
+        """
+        Run coroutine on the loop and wait for its result
+
+        Args:
+            coro (Coroutine): coroutine to run
+            timeout (float, optional): seconds to wait for result
+
+        Returns:
+            Any: result of coroutine
+        """
+        if self.thread is None or not self.thread.is_alive():
+            self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def stop(self, cleanup=None, timeout: float = 10):
+        """
+        Run cleanup coroutine, then stop and close the loop
+
+        Args:
+            cleanup (Coroutine, optional): coroutine releasing resources bound to the loop
+            timeout (float, optional): seconds to wait for cleanup
+        """
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                if cleanup is not None:
+                    cleanup.close()
+                return
+            if cleanup is not None:
+                try:
+                    asyncio.run_coroutine_threadsafe(cleanup, self.loop).result(timeout)
+                except Exception as e:
+                    print(f"Failed to clean up worker loop: {e}")
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(timeout)
+            self.loop.close()
+            self.loop = None
+            self.thread = None
+
+
+worker_loop = WorkerLoop()
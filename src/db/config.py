@@ -12,5 +12,72 @@ DB_PASS = os.environ.get("DB_PASS")
 REDIS_HOST = os.environ.get("REDIS_HOST")
 
 SECRET_HASH = os.environ.get("SECRET_HASH")
+# Comma separated keys that signed tokens before the last rotation of SECRET_HASH
+SECRET_HASH_PREVIOUS = [key for key in os.environ.get("SECRET_HASH_PREVIOUS", "").split(",") if key]
+JWT_CACHE_SIZE = int(os.environ.get("JWT_CACHE_SIZE", 10000))
+JWT_CACHE_TTL = int(os.environ.get("JWT_CACHE_TTL", 3600))
 
-TGBOTTOKEN = os.environ.get("TGBOTTOKEN")
\ No newline at end of file
+TGBOTTOKEN = os.environ.get("TGBOTTOKEN")
+# Telegram notifications about messages in one chat are coalesced over NOTIFY_WINDOW seconds
+# and sent at most NOTIFY_CHAT_RATE per second per recipient and NOTIFY_GLOBAL_RATE per second in total
+NOTIFY_WINDOW = float(os.environ.get("NOTIFY_WINDOW", 10))
+NOTIFY_CHAT_RATE = float(os.environ.get("NOTIFY_CHAT_RATE", 1))
+NOTIFY_GLOBAL_RATE = float(os.environ.get("NOTIFY_GLOBAL_RATE", 25))
+
+# Password hashing: scrypt cost parameters and size of the thread pool running it.
+# Changing the cost rehashes passwords of users on their next login.
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", 2))
+PASSWORD_SCRYPT_N = int(os.environ.get("PASSWORD_SCRYPT_N", 2 ** 14))
+PASSWORD_SCRYPT_R = int(os.environ.get("PASSWORD_SCRYPT_R", 8))
+PASSWORD_SCRYPT_P = int(os.environ.get("PASSWORD_SCRYPT_P", 1))
+
+# Write-behind persistence of messages: ids are generated in the app (Snowflake-style,
+# time ordered) and rows are inserted in batches. Keep it enabled once switched on:
+# ids taken from the sequence after switching back would sort before the generated ones.
+MESSAGE_WRITE_BEHIND = os.environ.get("MESSAGE_WRITE_BEHIND", "false").lower() == "true"
+MESSAGE_BATCH_SIZE = int(os.environ.get("MESSAGE_BATCH_SIZE", 500))
+MESSAGE_FLUSH_INTERVAL = float(os.environ.get("MESSAGE_FLUSH_INTERVAL", 0.005))
+MESSAGE_QUEUE_SIZE = int(os.environ.get("MESSAGE_QUEUE_SIZE", 10000))
+# Batches that can't be written are appended to MESSAGE_SPOOL_PATH, keep it on persistent storage
+MESSAGE_SPOOL_PATH = os.environ.get("MESSAGE_SPOOL_PATH", "message_spool.jsonl")
+# Worker ids of the generated ids are leased in Redis for SNOWFLAKE_LEASE_TTL seconds and refreshed
+# three times per TTL; a worker that can't lease one of the 64 ids refuses to start.
+SNOWFLAKE_LEASE_TTL = int(os.environ.get("SNOWFLAKE_LEASE_TTL", 30))
+
+# Outbound queue of every WebSocket connection and what to do when a slow client fills it:
+# "drop_oldest" discards the oldest queued frame, "disconnect" closes the connection
+WS_SEND_QUEUE_SIZE = int(os.environ.get("WS_SEND_QUEUE_SIZE", 256))
+WS_OVERFLOW_POLICY = os.environ.get("WS_OVERFLOW_POLICY", "drop_oldest")
+
+# Presence: every worker refreshes presence of its users each PRESENCE_HEARTBEAT seconds,
+# entries of a worker that stopped refreshing expire after PRESENCE_TTL seconds.
+# Going offline is announced only if the user is still offline after PRESENCE_DEBOUNCE seconds.
+PRESENCE_TTL = float(os.environ.get("PRESENCE_TTL", 30))
+PRESENCE_HEARTBEAT = float(os.environ.get("PRESENCE_HEARTBEAT", 10))
+PRESENCE_DEBOUNCE = float(os.environ.get("PRESENCE_DEBOUNCE", 5))
+
+# Application-level heartbeat: ping every WS_PING_INTERVAL seconds,
+# connections silent for WS_PING_TIMEOUT seconds are closed and removed
+WS_PING_INTERVAL = float(os.environ.get("WS_PING_INTERVAL", 20))
+WS_PING_TIMEOUT = float(os.environ.get("WS_PING_TIMEOUT", 60))
+
+# Messages are partitioned by month of time: partitions are created MESSAGE_PARTITIONS_AHEAD months
+# in advance. Partitions older than MESSAGE_ARCHIVE_AFTER_MONTHS months are moved to gzipped JSON lines
+# files under MESSAGE_ARCHIVE_PATH and dropped; 0 keeps all partitions in the database.
+MESSAGE_PARTITIONS_AHEAD = int(os.environ.get("MESSAGE_PARTITIONS_AHEAD", 3))
+MESSAGE_ARCHIVE_AFTER_MONTHS = int(os.environ.get("MESSAGE_ARCHIVE_AFTER_MONTHS", 0))
+MESSAGE_ARCHIVE_PATH = os.environ.get("MESSAGE_ARCHIVE_PATH", "message_archive")
+
+# Connection pools: DB_POOL_SIZE persistent connections per engine and up to DB_MAX_OVERFLOW more under load,
+# checked with a ping before use if DB_POOL_PRE_PING. Waiting longer than DB_POOL_TIMEOUT seconds for
+# a free connection fails the query. Replicas are comma separated host[:port] entries,
+# read-only queries go to them except for users who wrote in the last DB_READ_YOUR_WRITES seconds
+# on any worker, as recorded in Redis.
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() == "true"
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+DB_REPLICA_HOSTS = [host for host in os.environ.get("DB_REPLICA_HOSTS", "").split(",") if host]
+DB_REPLICA_POOL_SIZE = int(os.environ.get("DB_REPLICA_POOL_SIZE", DB_POOL_SIZE))
+DB_REPLICA_MAX_OVERFLOW = int(os.environ.get("DB_REPLICA_MAX_OVERFLOW", DB_MAX_OVERFLOW))
+DB_READ_YOUR_WRITES = float(os.environ.get("DB_READ_YOUR_WRITES", 5))
@@ -1,8 +1,12 @@
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import func, select, update, and_
+from sqlalchemy import func, select, update, and_, distinct, case, literal
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import aliased
 from .models import *
+from .db import readOnly
+from src.metrics import timed
 
+@timed
 async def userAdd(nickname: str, username: str, hashed_password: str, session: AsyncSession) -> int:
     """
     Add new user to database
@@ -22,6 +26,8 @@ async def userAdd(nickname: str, username: str, hashed_password: str, session: A
     await session.refresh(user)
     return user.id
 
+@timed
+@readOnly
 async def userGetAll(session: AsyncSession):
     """
     Get list of all users
@@ -36,6 +42,7 @@ async def userGetAll(session: AsyncSession):
     users = result.fetchall()
     return [{"id": user.id, "nickname": user.nickname} for user in users]
 
+@timed
 async def userGetById(idd: int, session: AsyncSession):
     """
     Get user by its id
@@ -60,6 +67,22 @@ async def userGetById(idd: int, session: AsyncSession):
         "tg_id": user.tg_id
     }
 
+@timed
+async def usersGetByIds(user_ids: list, session: AsyncSession):
+    """
+    Get several users by their ids with one query
+
+    Args:
+        user_ids (list): user ids
+        session (AsyncSession): connection to db
+
+    Returns:
+        dict: user id to dict containing nickname and telegram chat id, missing users are skipped
+    """
+    result = await session.execute(select(User.id, User.nickname, User.tg_id).where(User.id.in_(user_ids)))
+    return {row.id: {"nickname": row.nickname, "tg_id": row.tg_id} for row in result}
+
+@timed
 async def userGetByLogin(login: str, session: AsyncSession):
     """
     Get user by its login
@@ -78,19 +101,24 @@ async def userGetByLogin(login: str, session: AsyncSession):
     else:
         return {"username": res.username, "hashed_password": res.hashed_password, "id": res.id}
     
-def verifyPassword(passw: str, hashedPass: str) -> bool:
+@timed
+async def userSetPassword(user_id: int, hashed_password: str, session: AsyncSession) -> int:
     """
-    Checks if encrypted password same to decrypted one
+    Replace password hash of user with user_id
 
     Args:
-        passw (str): decrypted password
-        hashedPass (str): encrypted password
+        user_id (int): user id
+        hashed_password (str): encrypted password
+        session (AsyncSession): connection to db
 
     Returns:
-        bool: True, if same; False otherwise
+        int: user id
     """
-    return passw == hashedPass
+    await session.execute(update(User).where(User.id == user_id).values(hashed_password=hashed_password))
+    await session.commit()
+    return user_id
 
+@timed
 async def userSetTgId(user_id:int, tgId: int, session: AsyncSession) -> int:
     """
     Set telegram chat id for user with user_id
@@ -112,6 +140,7 @@ async def userSetTgId(user_id:int, tgId: int, session: AsyncSession) -> int:
     await session.commit()
     return user_id
 
+@timed
 async def addChat(session: AsyncSession, user_id: int, user_id2: int) -> int:
     """
     Add new chat for users with user_id and user_id2 to database
@@ -129,7 +158,8 @@ async def addChat(session: AsyncSession, user_id: int, user_id2: int) -> int:
         .join(ChatMembers)
         .filter(
             ChatMembers.user_id.in_([user_id, user_id2]),
-            Chat.id == ChatMembers.chat_id
+            Chat.id == ChatMembers.chat_id,
+            Chat.is_group.is_(False)
         )
         .group_by(Chat.id)
         .having(func.count() > 1)
@@ -150,6 +180,75 @@ async def addChat(session: AsyncSession, user_id: int, user_id2: int) -> int:
     return newChat.id
 
 
+@timed
+async def addGroupChat(session: AsyncSession, host_id: int, chat_name: str, user_ids: list) -> int:
+    """
+    Add new group chat created by user with host_id to database
+
+    Args:
+        session (AsyncSession): connection to db
+        host_id (int): id of user creating the chat, becomes its member too
+        chat_name (str): name of chat
+        user_ids (list): ids of other members
+
+    Returns:
+        int: id of created chat
+    """
+    newChat = Chat(chat_name=chat_name, host_id=host_id, is_group=True)
+    session.add(newChat)
+    await session.flush()
+    await addChatMembers(session, newChat.id, [host_id, *user_ids])
+    return newChat.id
+
+
+@timed
+async def addChatMembers(session: AsyncSession, chat_id: int, user_ids: list) -> list:
+    """
+    Add users to chat with one INSERT ... SELECT, skipping existing members and unknown users.
+    New members start with the current last message read, so earlier history doesn't count as unread.
+
+    Args:
+        session (AsyncSession): connection to db
+        chat_id (int): chat id
+        user_ids (list): ids of users to add
+
+    Returns:
+        list: ids of users who weren't members before
+    """
+    last_message_id = select(Chat.last_message_id).where(Chat.id == chat_id).scalar_subquery()
+    result = await session.execute(
+        insert(ChatMembers)
+        .from_select(
+            ['chat_id', 'user_id', 'last_read_message_id'],
+            select(literal(chat_id), User.id, last_message_id).where(User.id.in_(set(user_ids)))
+        )
+        .on_conflict_do_nothing(index_elements=['chat_id', 'user_id'])
+        .returning(ChatMembers.user_id)
+    )
+    added = list(result.scalars())
+    await session.commit()
+    return added
+
+
+@timed
+async def getChatById(session: AsyncSession, chat_id: int):
+    """
+    Get chat by its id
+
+    Args:
+        session (AsyncSession): connection to db
+        chat_id (int): chat id
+
+    Returns:
+        dict or None: dict containing chat name, host id and group flag, None if chat doesn't exist
+    """
+    chat = await session.get(Chat, chat_id)
+    if chat is None:
+        return None
+    return {'chat_name': chat.chat_name, 'host_id': chat.host_id, 'is_group': chat.is_group}
+
+
+@timed
 async def addMessage(session: AsyncSession, chat_id: int, user_id:int, message: str, time: DateTime) -> int:
     """
     Add new message to database
@@ -166,11 +265,20 @@ async def addMessage(session: AsyncSession, chat_id: int, user_id:int, message:
     """
     newMessage = Message(chat_id=chat_id, sender_id=user_id, text=message, time=time)
     session.add(newMessage)
+    await session.flush()
+    await session.execute(
+        update(Chat)
+        .where(Chat.id == chat_id)
+        # a concurrent send committing later must not move the summary back to an older message
+        .where(Chat.last_message_id.is_(None) | (Chat.last_message_id < newMessage.id))
+        .values(last_message_id=newMessage.id, last_message_text=message, last_message_time=time)
+    )
     await session.commit()
-    await session.refresh(newMessage)
     return newMessage.id
 
 
+@timed
+@readOnly
 async def getUserChats(session: AsyncSession, user_id: int):
     """
     Get list of user chats by user id
@@ -180,54 +288,34 @@ async def getUserChats(session: AsyncSession, user_id: int):
         user_id (int): user id which chats returns
 
     Returns:
-        list: list of dicts containing chat id, name of another user in chat, last message content and last message time
+        list: list of dicts containing chat id, name of another user in chat (name of group chat),
+            group flag, last message content and last message time
     """
-    chat_ids_subquery = (
-        select(ChatMembers.chat_id)
-        .where(ChatMembers.user_id == user_id)
-        .subquery()
-    )
-
-    chat_members_subquery = (
-        select(ChatMembers.chat_id, ChatMembers.user_id)
-        .where(ChatMembers.chat_id.in_(chat_ids_subquery))
-        .where(ChatMembers.user_id != user_id)
-        .subquery()
-    )
-
-    last_message_subquery = (
-        select(
-            Message.chat_id,
-            func.max(Message.time).label('last_message_time')
-        )
-        .group_by(Message.chat_id)
-        .subquery()
-    )
+    member = aliased(ChatMembers)
+    participant = aliased(ChatMembers)
 
     query = (
         select(
-            chat_members_subquery.c.chat_id,
+            member.chat_id,
             # User.avatar_url.label('avatar'),
-            User.nickname.label('participant_name'),
-            Message.text.label('last_message_text'),
-            last_message_subquery.c.last_message_time
-        )
-        .select_from(chat_members_subquery)
-        .outerjoin(
-            last_message_subquery,
-            chat_members_subquery.c.chat_id == last_message_subquery.c.chat_id
+            case((Chat.is_group, Chat.chat_name), else_=User.nickname).label('participant_name'),
+            Chat.is_group,
+            Chat.last_message_text,
+            Chat.last_message_time
         )
+        .select_from(member)
+        .join(Chat, Chat.id == member.chat_id)
         .outerjoin(
-            Message,
+            participant,
             and_(
-                Message.chat_id == chat_members_subquery.c.chat_id,
-                Message.time == last_message_subquery.c.last_message_time
+                participant.chat_id == member.chat_id,
+                participant.user_id != user_id,
+                Chat.is_group.is_(False)
             )
         )
-        .join(
-            User,
-            User.id == chat_members_subquery.c.user_id
-        )
+        .outerjoin(User, User.id == participant.user_id)
+        .where(member.user_id == user_id)
+        .order_by(Chat.last_message_time.desc().nulls_last())
     )
     
     
@@ -240,6 +328,7 @@ async def getUserChats(session: AsyncSession, user_id: int):
             'chat_id': row.chat_id,
             # 'avatar': row.avatar,
             'participant_name': row.participant_name,
+            'is_group': row.is_group,
             'last_message_text': row.last_message_text,
             'last_message_time': row.last_message_time
         }
@@ -249,18 +338,25 @@ async def getUserChats(session: AsyncSession, user_id: int):
     return chat_list
 
 
-async def getMessagesByChatId(session: AsyncSession, chat_id: int):
+@timed
+@readOnly
+async def getMessagesByChatId(session: AsyncSession, chat_id: int, before_id: int = None, limit: int = 50):
     """
-    Get list of messages by chat id
+    Get page of messages by chat id, newest first
 
     Args:
         session (AsyncSession): connection to db
         chat_id (int): chat id which messages returns
+        before_id (int, optional): return only messages with id lower than this one; from the newest message if None
+        limit (int, optional): max number of messages in page
 
     Returns:
         list: list of dicts containing message info
     """
-    query = select(Message).where(Message.chat_id == chat_id).order_by(Message.time)
+    query = select(Message).where(Message.chat_id == chat_id)
+    if before_id is not None:
+        query = query.where(Message.id < before_id)
+    query = query.order_by(Message.id.desc()).limit(limit)
     
     result = await session.execute(query)
     rows = result.fetchall()
@@ -278,6 +374,59 @@ async def getMessagesByChatId(session: AsyncSession, chat_id: int):
     
     return message_list
 
+@timed
+@readOnly
+async def searchMessages(session: AsyncSession, user_id: int, text: str, chat_id: int = None, limit: int = 20, offset: int = 0):
+    """
+    Full-text search of messages in chats of user, most relevant first
+
+    Args:
+        session (AsyncSession): connection to db
+        user_id (int): user id which chats are searched
+        text (str): search query in web search syntax ("quoted phrases", or, -excluded words)
+        chat_id (int, optional): search only this chat; all chats of user if None
+        limit (int, optional): max number of messages in page
+        offset (int, optional): number of messages to skip
+
+    Returns:
+        list: list of dicts containing message info, rank and snippet with matches wrapped in <b></b>
+    """
+    query = func.websearch_to_tsquery('simple', text)
+    rank = func.ts_rank(Message.search_vector, query).label('rank')
+
+    page = (
+        select(Message.id, Message.chat_id, Message.sender_id, Message.text, Message.time, rank)
+        .join(ChatMembers, and_(ChatMembers.chat_id == Message.chat_id, ChatMembers.user_id == user_id))
+        .where(Message.search_vector.op('@@')(query))
+    )
+    if chat_id is not None:
+        page = page.where(Message.chat_id == chat_id)
+    page = page.order_by(rank.desc(), Message.id.desc()).limit(limit).offset(offset).subquery()
+
+    # snippets are built for the page only, not for every match
+    result = await session.execute(
+        select(
+            page,
+            func.ts_headline('simple', page.c.text, query, 'MaxFragments=2, MaxWords=20, MinWords=5').label('snippet')
+        )
+        .order_by(page.c.rank.desc(), page.c.id.desc())
+    )
+
+    return [
+        {
+            'message_id': row.id,
+            'chat_id': row.chat_id,
+            'sender_id': row.sender_id,
+            'text': row.text,
+            'snippet': row.snippet,
+            'rank': row.rank,
+            'time': row.time.isoformat()
+        }
+        for row in result
+    ]
+
+@timed
+@readOnly
 async def getChatMembersByChatId(session: AsyncSession, chat_id: int):
     """
     Get members of chat by chat id
@@ -303,6 +452,105 @@ async def getChatMembersByChatId(session: AsyncSession, chat_id: int):
     
     return user_list
 
+@timed
+async def getContactIdsByUserId(session: AsyncSession, user_id: int):
+    """
+    Get ids of users having a private chat with user
+
+    Args:
+        session (AsyncSession): connection to db
+        user_id (int): user id which contacts returns
+
+    Returns:
+        list: list of user ids
+    """
+    member = aliased(ChatMembers)
+    contact = aliased(ChatMembers)
+
+    query = (
+        select(distinct(contact.user_id))
+        .select_from(member)
+        .join(contact, contact.chat_id == member.chat_id)
+        .join(Chat, Chat.id == member.chat_id)
+        .where(member.user_id == user_id)
+        .where(Chat.is_group.is_(False))
+        .where(contact.user_id != user_id)
+    )
+
+    result = await session.execute(query)
+    return list(result.scalars())
+
+@timed
+async def getUnreadCounts(session: AsyncSession, user_id: int):
+    """
+    Count messages of other users after the last read message in every chat of user
+
+    Args:
+        session (AsyncSession): connection to db
+        user_id (int): user id which counters returns
+
+    Returns:
+        dict: chat id to number of unread messages, chats without unread messages are skipped
+    """
+    query = (
+        select(ChatMembers.chat_id, func.count(Message.id))
+        .join(
+            Message,
+            and_(
+                Message.chat_id == ChatMembers.chat_id,
+                Message.id > func.coalesce(ChatMembers.last_read_message_id, 0),
+                Message.sender_id != user_id
+            )
+        )
+        .where(ChatMembers.user_id == user_id)
+        .group_by(ChatMembers.chat_id)
+    )
+
+    result = await session.execute(query)
+    return {row[0]: row[1] for row in result}
+
+@timed
+async def markChatRead(session: AsyncSession, chat_id: int, user_id: int, message_id: int, newest_id: int = None):
+    """
+    Move read marker of user in chat forward to message_id, clamped to the last message of chat
+
+    Args:
+        session (AsyncSession): connection to db
+        chat_id (int): chat id
+        user_id (int): id of reader
+        message_id (int): id of the newest message read, as sent by client
+        newest_id (int, optional): highest id a message not written yet may have, for ids allocated before insert
+
+    Returns:
+        dict or None: dict containing message_id the marker was moved to and unread_count, number of messages
+            of other users still unread; None if marker already was at or after message_id
+    """
+    last_message_id = select(Chat.last_message_id).where(Chat.id == chat_id).scalar_subquery()
+    if newest_id is not None:
+        last_message_id = func.greatest(last_message_id, newest_id)
+    message_id = func.least(message_id, func.coalesce(last_message_id, 0))
+    result = await session.execute(
+        update(ChatMembers)
+        .where(ChatMembers.chat_id == chat_id)
+        .where(ChatMembers.user_id == user_id)
+        .where(ChatMembers.last_read_message_id.is_(None) | (ChatMembers.last_read_message_id < message_id))
+        .values(last_read_message_id=message_id)
+        .returning(ChatMembers.last_read_message_id)
+    )
+    message_id = result.scalar()
+    if message_id is None:
+        await session.rollback()
+        return None
+    unread = await session.scalar(
+        select(func.count(Message.id))
+        .where(Message.chat_id == chat_id)
+        .where(Message.id > message_id)
+        .where(Message.sender_id != user_id)
+    )
+    await session.commit()
+    return {'message_id': message_id, 'unread_count': unread}
+
+@timed
 async def isExistChatByUserIds(session: AsyncSession, user_id:int, user_id2: int):
     """
     Checks if chat with user_id and user_id2 already exists
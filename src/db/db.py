@@ -1,14 +1,134 @@
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from contextlib import contextmanager
+from contextvars import ContextVar
 from src.db.config import *
+import functools
+import random
+import time
 
-DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASS}@{DB_HOST}/{DB_NAME}"
+"""
+    Engines of the primary database and its read replicas, sessions routing queries between them
+"""
+
+DATABASE_URL = "postgresql+asyncpg://{user}:{password}@{host}/{name}"
 Base = declarative_base()
 
 
-engine = create_async_engine(DATABASE_URL)
-async_session_maker = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+def database_url(host: str) -> str:
+    return DATABASE_URL.format(user=DB_USER, password=DB_PASS, host=host, name=DB_NAME)
+
+
+engine = create_async_engine(
+    database_url(f"{DB_HOST}:{DB_PORT}" if DB_PORT else DB_HOST),
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_pre_ping=DB_POOL_PRE_PING,
+    pool_timeout=DB_POOL_TIMEOUT,
+)
+replica_engines = [
+    create_async_engine(
+        database_url(host),
+        pool_size=DB_REPLICA_POOL_SIZE,
+        max_overflow=DB_REPLICA_MAX_OVERFLOW,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        pool_timeout=DB_POOL_TIMEOUT,
+    )
+    for host in DB_REPLICA_HOSTS
+]
+
+# Set while a function marked with readOnly runs
+read_only = ContextVar("read_only", default=False)
+# Set inside primaryOnly, overrides read_only of readOnly functions called there
+primary_only = ContextVar("primary_only", default=False)
+# Id of user the current request is made by, set by authentication
+current_user = ContextVar("current_user", default=None)
+# Monotonic time until which reads of the current user go to the primary, set by authentication
+# from the rw:{uid} key shared by all workers and moved forward by writes of the user
+sticky_until = ContextVar("sticky_until", default=0.0)
+
+
+def readOnly(func):
+    """
+    Mark CRUD function as one that only reads and tolerates replication lag, so its queries may go to a replica
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        token = read_only.set(True)
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            read_only.reset(token)
+    return wrapper
+
+
+@contextmanager
+def primaryOnly():
+    """
+    Send queries of readOnly functions called inside to the primary, for reads that fill shared caches
+    """
+    token = primary_only.set(True)
+    try:
+        yield
+    finally:
+        primary_only.reset(token)
+
+
+class RoutingSession(Session):
+    """
+    Session sending queries of readOnly functions to a random replica and everything else to the primary.
+
+    Once a session writes, it reads only from the primary, and so does the user who
+    made the write, for DB_READ_YOUR_WRITES seconds. The user is recorded in
+    session.info["writer"], so the window can be shared with other workers on commit.
+    """
+    def get_bind(self, mapper=None, clause=None, **kw):
+        user_id = current_user.get()
+        if self._flushing or (clause is not None and clause.is_dml):
+            self.info["wrote"] = True
+            if user_id is not None:
+                self.info["writer"] = user_id
+                sticky_until.set(time.monotonic() + DB_READ_YOUR_WRITES)
+        elif (
+            replica_engines
+            and read_only.get()
+            and not primary_only.get()
+            and not self.info.get("wrote")
+            and sticky_until.get() < time.monotonic()
+        ):
+            return random.choice(replica_engines).sync_engine
+        return engine.sync_engine
+
+
+async_session_maker = sessionmaker(class_=AsyncSession, sync_session_class=RoutingSession, expire_on_commit=False)
+
+
+def poolStats() -> dict:
+    """
+    Utilization of connection pools of the primary and replicas
+
+    Returns:
+        dict: for the primary and every replica, number of connections checked out, idle in pool,
+            opened over pool size, pool capacity and share of capacity in use
+    """
+    def stats(engine, capacity: int) -> dict:
+        pool = engine.pool
+        return {
+            'checked_out': pool.checkedout(),
+            'checked_in': pool.checkedin(),
+            'overflow': max(pool.overflow(), 0),
+            'capacity': capacity,
+            'utilization': pool.checkedout() / capacity if capacity else 0,
+        }
+
+    return {
+        'primary': stats(engine, DB_POOL_SIZE + DB_MAX_OVERFLOW),
+        'replicas': {
+            host: stats(replica, DB_REPLICA_POOL_SIZE + DB_REPLICA_MAX_OVERFLOW)
+            for host, replica in zip(DB_REPLICA_HOSTS, replica_engines)
+        },
+    }
 
 
 async def get_async_session():
@@ -19,4 +139,4 @@ async def get_async_session():
         AsyncSession: returns connection to database
     """
     async with async_session_maker() as session:
-        yield session
\ No newline at end of file
+        yield session
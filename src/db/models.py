@@ -1,4 +1,6 @@
-from sqlalchemy import Column, String, Integer, ForeignKey, DateTime
+from sqlalchemy import Column, String, Integer, BigInteger, Boolean, ForeignKey, DateTime, Index, Computed, Sequence, false
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import deferred
 from .db import Base
 
 
@@ -16,18 +18,51 @@ class Chat(Base):
     id = Column(Integer, primary_key=True, index=True)
     chat_name = Column(String)
     host_id = Column(Integer)
+    is_group = Column(Boolean, nullable=False, default=False, server_default=false())
+    last_message_id = Column(BigInteger)
+    last_message_text = Column(String)
+    last_message_time = Column(DateTime)
     
     
 class Message(Base):
     __tablename__ = "messages"
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(BigInteger, Sequence('messages_id_seq'), primary_key=True, index=True)
     chat_id = Column(Integer, ForeignKey('chats.id'))
     sender_id = Column(Integer, ForeignKey('users.id'))
     text = Column(String)
-    time = Column(DateTime)
+    time = Column(DateTime, primary_key=True)
+    search_vector = deferred(Column(TSVECTOR, Computed("to_tsvector('simple', coalesce(text, ''))", persisted=True)))
+
+    __table_args__ = (
+        Index('ix_messages_chat_id_id', 'chat_id', 'id'),
+        Index('ix_messages_search_vector', 'search_vector', postgresql_using='gin'),
+        {'postgresql_partition_by': 'RANGE (time)'},
+    )
     
 class ChatMembers(Base):
     __tablename__ = "chatmembers"
     id = Column(Integer, primary_key=True, index=True)
     chat_id = Column(Integer, ForeignKey('chats.id'))
-    user_id = Column(Integer, ForeignKey('users.id'))
\ No newline at end of file
+    user_id = Column(Integer, ForeignKey('users.id'))
+    last_read_message_id = Column(BigInteger)
+
+    __table_args__ = (
+        Index('ix_chatmembers_chat_id_user_id', 'chat_id', 'user_id', unique=True),
+        Index('ix_chatmembers_user_id_chat_id', 'user_id', 'chat_id'),
+    )
+
+
+class MessageArchive(Base):
+    __tablename__ = "message_archives"
+    id = Column(Integer, primary_key=True, index=True)
+    chat_id = Column(Integer, ForeignKey('chats.id'))
+    partition_name = Column(String)
+    path = Column(String)
+    min_id = Column(BigInteger)
+    max_id = Column(BigInteger)
+    messages_count = Column(Integer)
+
+    __table_args__ = (
+        Index('ix_message_archives_chat_id_partition_name', 'chat_id', 'partition_name', unique=True),
+        Index('ix_message_archives_chat_id_max_id', 'chat_id', 'max_id'),
+    )
@@ -0,0 +1,249 @@
+from sqlalchemy import func, select, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+from datetime import date, datetime
+from functools import lru_cache
+from src.db.config import *
+from src.db.db import async_session_maker
+from src.db.models import MessageArchive
+import asyncio
+import gzip
+import json
+import logging
+import os
+import re
+
+"""
+    Monthly partitions of messages and archival of old ones to compressed files
+"""
+
+logger = logging.getLogger(__name__)
+
+PARTITION_NAME = "messages_y{:04d}m{:02d}"
+PARTITION_PATTERN = re.compile(r"^messages_y(\d{4})m(\d{2})$")
+# Key of the advisory lock serializing partition maintenance of all workers
+PARTITION_LOCK = 0x6D736770
+
+
+def addMonths(month: date, months: int) -> date:
+    """
+    Get first day of month shifted by a number of months
+
+    Args:
+        month (date): any day of month
+        months (int): number of months to shift, negative to go back
+
+    Returns:
+        date: first day of shifted month
+    """
+    years, index = divmod(month.month - 1 + months, 12)
+    return date(month.year + years, index + 1, 1)
+
+
+async def ensurePartitions(session: AsyncSession, months_ahead: int = MESSAGE_PARTITIONS_AHEAD):
+    """
+    Create partitions of messages for the current month and months_ahead next ones
+
+    Args:
+        session (AsyncSession): connection to db
+        months_ahead (int, optional): number of months to create in advance
+    """
+    await session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': PARTITION_LOCK})
+    current = datetime.utcnow().date().replace(day=1)
+    for shift in range(months_ahead + 1):
+        start = addMonths(current, shift)
+        end = addMonths(start, 1)
+        await session.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {PARTITION_NAME.format(start.year, start.month)} "
+            f"PARTITION OF messages FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+        ))
+    await session.commit()
+
+
+async def getPartitions(session: AsyncSession) -> list:
+    """
+    Get monthly partitions of messages attached now
+
+    Args:
+        session (AsyncSession): connection to db
+
+    Returns:
+        list: first days of months having a partition, oldest first
+    """
+    result = await session.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'messages'::regclass"
+    ))
+    months = []
+    for name in result.scalars():
+        match = PARTITION_PATTERN.match(name)
+        if match:
+            months.append(date(int(match.group(1)), int(match.group(2)), 1))
+    return sorted(months)
+
+
+async def archivePartitions(
+    session_maker: sessionmaker = async_session_maker,
+    after_months: int = MESSAGE_ARCHIVE_AFTER_MONTHS,
+    path: str = MESSAGE_ARCHIVE_PATH,
+) -> list:
+    """
+    Move partitions older than after_months months to files and drop them
+
+    Args:
+        session_maker (sessionmaker, optional): factory of connections to db
+        after_months (int, optional): age in months of the newest partition kept in db, 0 disables archival
+        path (str, optional): directory of archive files
+
+    Returns:
+        list: names of archived partitions
+    """
+    if after_months <= 0:
+        return []
+    cutoff = addMonths(datetime.utcnow().date(), -after_months)
+    async with session_maker() as session:
+        months = [month for month in await getPartitions(session) if month < cutoff]
+
+    archived = []
+    for month in months:
+        name = PARTITION_NAME.format(month.year, month.month)
+        async with session_maker() as session:
+            await archivePartition(session, name, path)
+        archived.append(name)
+    return archived
+
+
+async def archivePartition(session: AsyncSession, name: str, path: str):
+    """
+    Write messages of partition to one gzipped JSON lines file per chat, register the files
+    in message_archives and drop the partition, all in one transaction
+
+    Files are written before the transaction commits, so a failed run leaves the partition
+    in place and the next run overwrites the files.
+
+    Args:
+        session (AsyncSession): connection to db
+        name (str): name of partition
+        path (str): directory of archive files
+    """
+    directory = os.path.join(path, name)
+    os.makedirs(directory, exist_ok=True)
+    await session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': PARTITION_LOCK})
+
+    archives = []
+    archive = None
+    spool = None
+    rows = await session.stream(text(f"SELECT id, chat_id, sender_id, text, time FROM {name} ORDER BY chat_id, id"))
+    async for row in rows:
+        if archive is None or archive['chat_id'] != row.chat_id:
+            if spool:
+                spool.close()
+                os.replace(f"{archive['path']}.tmp", archive['path'])
+            archive = {
+                'chat_id': row.chat_id,
+                'partition_name': name,
+                'path': os.path.join(directory, f"{row.chat_id}.jsonl.gz"),
+                'min_id': row.id,
+                'max_id': row.id,
+                'messages_count': 0,
+            }
+            archives.append(archive)
+            spool = gzip.open(f"{archive['path']}.tmp", 'wt')
+        spool.write(json.dumps({
+            'message_id': row.id,
+            'chat_id': row.chat_id,
+            'sender_id': row.sender_id,
+            'text': row.text,
+            'time': row.time.isoformat()
+        }) + '\n')
+        archive['max_id'] = row.id
+        archive['messages_count'] += 1
+    if spool:
+        spool.close()
+        os.replace(f"{archive['path']}.tmp", archive['path'])
+
+    if archives:
+        statement = insert(MessageArchive).values(archives)
+        await session.execute(statement.on_conflict_do_update(
+            index_elements=['chat_id', 'partition_name'],
+            set_={column: statement.excluded[column] for column in ('path', 'min_id', 'max_id', 'messages_count')}
+        ))
+    await session.execute(text(f"ALTER TABLE messages DETACH PARTITION {name}"))
+    await session.execute(text(f"DROP TABLE {name}"))
+    await session.commit()
+    logger.info(f"Archived {sum(archive['messages_count'] for archive in archives)} messages of {name}")
+
+
+async def maintainPartitions(session_maker: sessionmaker = async_session_maker) -> list:
+    """
+    Create upcoming partitions and archive old ones
+
+    Args:
+        session_maker (sessionmaker, optional): factory of connections to db
+
+    Returns:
+        list: names of archived partitions
+    """
+    async with session_maker() as session:
+        await ensurePartitions(session)
+    return await archivePartitions(session_maker)
+
+
+@lru_cache(maxsize=32)
+def readArchive(path: str) -> tuple:
+    """
+    Read messages of archive file, recently read files are kept decoded
+
+    Args:
+        path (str): path of archive file
+
+    Returns:
+        tuple: messages of file, newest first
+    """
+    with gzip.open(path, 'rt') as archive:
+        return tuple(reversed([json.loads(line) for line in archive if line.strip()]))
+
+
+async def getNewestArchivedId(session: AsyncSession, chat_id: int):
+    """
+    Get id of the newest archived message of chat
+
+    Args:
+        session (AsyncSession): connection to db
+        chat_id (int): chat id
+
+    Returns:
+        int or None: message id, None if chat has no archived messages
+    """
+    return await session.scalar(select(func.max(MessageArchive.max_id)).where(MessageArchive.chat_id == chat_id))
+
+
+async def getArchivedMessages(session: AsyncSession, chat_id: int, before_id: int = None, limit: int = 50):
+    """
+    Get page of archived messages by chat id, newest first, reading archive files only as far as needed
+
+    Args:
+        session (AsyncSession): connection to db
+        chat_id (int): chat id which messages returns
+        before_id (int, optional): return only messages with id lower than this one; from the newest archived message if None
+        limit (int, optional): max number of messages in page
+
+    Returns:
+        list: list of dicts containing message info, in the format of getMessagesByChatId
+    """
+    query = select(MessageArchive.path).where(MessageArchive.chat_id == chat_id)
+    if before_id is not None:
+        query = query.where(MessageArchive.min_id < before_id)
+    paths = (await session.scalars(query.order_by(MessageArchive.max_id.desc()))).all()
+
+    messages = []
+    for path in paths:
+        archived = await asyncio.get_running_loop().run_in_executor(None, readArchive, path)
+        messages.extend(
+            message for message in archived
+            if before_id is None or message['message_id'] < before_id
+        )
+        if len(messages) >= limit:
+            break
+    return messages[:limit]
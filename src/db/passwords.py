@@ -0,0 +1,63 @@
+from concurrent.futures import ThreadPoolExecutor
+from src.db.config import PASSWORD_HASH_WORKERS, PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+
+"""
+    Password hashing with scrypt, run in a dedicated thread pool.
+    OpenSSL releases the GIL while hashing, so logins don't stall the event loop.
+"""
+
+SCHEME = "scrypt"
+
+executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r * p + 2 ** 20, dklen=32)
+
+
+def _encode(data: bytes) -> str:
+    return base64.b64encode(data).decode()
+
+
+async def hashPassword(password: str) -> str:
+    """
+    Hash password with current cost parameters
+
+    Args:
+        password (str): plaintext password
+
+    Returns:
+        str: hash in format scrypt$n$r$p$salt$hash
+    """
+    salt = os.urandom(16)
+    n, r, p = PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P
+    digest = await asyncio.get_running_loop().run_in_executor(executor, _scrypt, password, salt, n, r, p)
+    return f"{SCHEME}${n}${r}${p}${_encode(salt)}${_encode(digest)}"
+
+
+async def verifyPassword(password: str, hashedPass: str):
+    """
+    Checks if password matches stored hash
+
+    Args:
+        password (str): plaintext password
+        hashedPass (str): stored hash, or plaintext password stored before hashing was introduced
+
+    Returns:
+        tuple: (True if password matches, True if stored hash should be replaced with a hash using current parameters)
+    """
+    if not hashedPass:
+        return False, False
+    if not hashedPass.startswith(f"{SCHEME}$"):
+        return hmac.compare_digest(password.encode(), hashedPass.encode()), True
+
+    _, n, r, p, salt, digest = hashedPass.split("$")
+    n, r, p = int(n), int(r), int(p)
+    expected = await asyncio.get_running_loop().run_in_executor(executor, _scrypt, password, base64.b64decode(salt), n, r, p)
+    matches = hmac.compare_digest(expected, base64.b64decode(digest))
+    return matches, (n, r, p) != (PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P)
@@ -1,4 +1,5 @@
 from src.db.crud import *
+from src.db import passwords
 from sqlalchemy.ext.asyncio import AsyncSession
 
 """
@@ -11,13 +12,19 @@ class UserService:
     async def userAdd(self, nickname: str, username: str, hashed_password: str, session: AsyncSession):
         if await userGetByLogin(username, session):
             return -1
-        return await userAdd(nickname, username, hashed_password, session)
+        return await userAdd(nickname, username, await passwords.hashPassword(hashed_password), session)
     
     async def userGetAll(self, session: AsyncSession):
         return await userGetAll(session)
     
-    def verifyPassword(self, pass1, pass2):
-        return verifyPassword(pass1, pass2)
+    async def usersGetByIds(self, uids: list, session: AsyncSession):
+        return await usersGetByIds(uids, session)
+    
+    async def verifyPassword(self, password: str, usr: dict, session: AsyncSession):
+        matches, outdated = await passwords.verifyPassword(password, usr['hashed_password'])
+        if matches and outdated:
+            await userSetPassword(usr['id'], await passwords.hashPassword(password), session)
+        return matches
     
     async def userGetByLogin(self, login: str, session: AsyncSession):
         return await userGetByLogin(login, session)
@@ -29,14 +36,29 @@ class MessageService:
     async def addMessage(self, chat_id: int, user_id: int, message: str, time: DateTime, session: AsyncSession):
         return await addMessage(session, chat_id, user_id, message, time)
     
-    async def getMessagesByChatId(self, session: AsyncSession, chat_id: int):
-        return await getMessagesByChatId(session, chat_id)
+    async def getMessagesByChatId(self, session: AsyncSession, chat_id: int, before_id: int = None, limit: int = 50):
+        return await getMessagesByChatId(session, chat_id, before_id, limit)
+    
+    async def searchMessages(self, session: AsyncSession, user_id: int, text: str, chat_id: int = None, limit: int = 20, offset: int = 0):
+        return await searchMessages(session, user_id, text, chat_id, limit, offset)
 
 
 
 class ChatMemberService:
     async def getChatMembersByChatId(self, session: AsyncSession, chat_id: int):
         return await getChatMembersByChatId(session, chat_id)
+    
+    async def getContactIdsByUserId(self, session: AsyncSession, user_id: int):
+        return await getContactIdsByUserId(session, user_id)
+    
+    async def addChatMembers(self, session: AsyncSession, chat_id: int, user_ids: list):
+        return await addChatMembers(session, chat_id, user_ids)
+    
+    async def getUnreadCounts(self, session: AsyncSession, user_id: int):
+        return await getUnreadCounts(session, user_id)
+    
+    async def markChatRead(self, session: AsyncSession, chat_id: int, user_id: int, message_id: int, newest_id: int = None):
+        return await markChatRead(session, chat_id, user_id, message_id, newest_id)
 
 
 
@@ -47,6 +69,12 @@ class ChatService:
     async def addChat(self, session: AsyncSession, user_id: int, user_id2: int):
         return await addChat(session, user_id, user_id2)
     
+    async def addGroupChat(self, session: AsyncSession, host_id: int, chat_name: str, user_ids: list):
+        return await addGroupChat(session, host_id, chat_name, user_ids)
+    
+    async def getChatById(self, session: AsyncSession, chat_id: int):
+        return await getChatById(session, chat_id)
+    
     async def isExistChatByUserIds(self, session: AsyncSession, user_id:int, user_id2: int):
         return await isExistChatByUserIds(session, user_id, user_id2)
 
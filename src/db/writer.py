@@ -0,0 +1,291 @@
+from sqlalchemy import update, bindparam
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import sessionmaker
+from datetime import datetime
+from typing import Awaitable, Callable, Optional
+from src.db.config import *
+from src.db.db import async_session_maker
+from src.db.models import Chat, Message
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+
+"""
+    Write-behind persistence of messages
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class SnowflakeIds:
+    """
+    Time ordered ids: milliseconds since EPOCH_MS, 6 bits of worker id and 6 bits of sequence.
+    53 bits in total, so ids stay exact as JavaScript numbers in the client.
+    """
+    EPOCH_MS = 1704067200000
+
+    def __init__(self, worker_id: int):
+        self.worker_id = worker_id & 0x3F
+        self.last = 0
+        self.seq = 0
+
+    def next(self) -> int:
+        now = max(int(time.time() * 1000) - self.EPOCH_MS, self.last)
+        if now == self.last:
+            self.seq = (self.seq + 1) & 0x3F
+            if self.seq == 0:
+                now += 1
+        else:
+            self.seq = 0
+        self.last = now
+        return (now << 12) | (self.worker_id << 6) | self.seq
+
+    def newest(self) -> int:
+        """
+        Highest id any worker may have allocated by now
+        """
+        return (max(int(time.time() * 1000) - self.EPOCH_MS, self.last) << 12) | 0xFFF
+
+
+class WorkerIdLease:
+    """
+    Lease of a Snowflake worker id unique among running workers, kept in Redis as
+    snowflake:worker:{id} keys expiring unless refreshed by the holder.
+
+    Args:
+        redis_client: asyncio Redis client
+        ttl (int, optional): seconds the lease survives its holder
+    """
+    KEY = "snowflake:worker:{}"
+    WORKER_IDS = 64
+
+    # Prolongs lease KEYS[1] if held by ARGV[1], takes it back if it expired meanwhile
+    REFRESH = """
+    local holder = redis.call('GET', KEYS[1])
+    if holder == ARGV[1] then
+        return redis.call('EXPIRE', KEYS[1], ARGV[2])
+    elseif not holder then
+        redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+        return 1
+    end
+    return 0
+    """
+    # Deletes lease KEYS[1] if held by ARGV[1]
+    RELEASE = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(self, redis_client, ttl: int = SNOWFLAKE_LEASE_TTL):
+        self.redis_client = redis_client
+        self.ttl = ttl
+        self.token = uuid.uuid4().hex
+        self.worker_id = None
+        self.task = None
+        self.refresh_script = redis_client.register_script(self.REFRESH)
+        self.release_script = redis_client.register_script(self.RELEASE)
+
+    async def acquire(self) -> int:
+        """
+        Lease the first free worker id and keep refreshing it
+
+        Raises:
+            RuntimeError: all worker ids are leased
+
+        Returns:
+            int: leased worker id
+        """
+        for worker_id in range(self.WORKER_IDS):
+            if await self.redis_client.set(self.KEY.format(worker_id), self.token, nx=True, ex=self.ttl):
+                self.worker_id = worker_id
+                self.task = asyncio.create_task(self._heartbeat())
+                return worker_id
+        raise RuntimeError(f"All {self.WORKER_IDS} Snowflake worker ids are leased")
+
+    async def release(self):
+        """
+        Stop refreshing the lease and free the worker id
+        """
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            await self.release_script(keys=[self.KEY.format(self.worker_id)], args=[self.token])
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                if not await self.refresh_script(keys=[self.KEY.format(self.worker_id)], args=[self.token, self.ttl]):
+                    logger.error(f"Snowflake worker id {self.worker_id} was leased by another worker")
+            except Exception as e:
+                logger.warning(f"Failed to refresh lease of Snowflake worker id {self.worker_id}: {e}")
+
+
+class MessageWriter:
+    """
+    Allocates message ids up front and persists messages in batches from a background task.
+
+    Messages are collected in a bounded queue, so senders slow down instead of
+    piling up memory when the database falls behind. A batch is flushed every
+    flush_interval seconds or batch_size messages with one multi-row INSERT,
+    together with the last message summary of the affected chats. Batches that
+    can't be written are spooled to a JSON lines file and replayed on next start.
+    Caches that must not see a message before it is in the database are updated
+    by the on_flush callback, called with every written batch.
+    """
+    def __init__(
+        self,
+        session_maker: sessionmaker = async_session_maker,
+        batch_size: int = MESSAGE_BATCH_SIZE,
+        flush_interval: float = MESSAGE_FLUSH_INTERVAL,
+        queue_size: int = MESSAGE_QUEUE_SIZE,
+        spool_path: str = MESSAGE_SPOOL_PATH,
+    ):
+        self.session_maker = session_maker
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.queue = None
+        self.spool_path = spool_path
+        self.ids = None
+        self.task = None
+        self.on_flush = None
+
+    async def start(self, worker_id: int, on_flush: Optional[Callable[[list], Awaitable]] = None):
+        """
+        Replay spooled messages and start flushing
+
+        Args:
+            worker_id (int): id of this worker, unique among running workers, as leased by WorkerIdLease
+            on_flush (Callable, optional): coroutine function called with rows of every batch after it is committed
+        """
+        self.ids = SnowflakeIds(worker_id)
+        self.on_flush = on_flush
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        await self._replay()
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        Flush queued messages and stop, spooling them to disk if db is unavailable
+        """
+        if self.task:
+            await self.queue.put(None)
+            await self.task
+
+    def newestId(self) -> int:
+        """
+        Highest id a message queued by any worker may have by now, messages with ids up to it may be not written yet
+
+        Returns:
+            int: message id
+        """
+        return self.ids.newest()
+
+    async def addMessage(self, chat_id: int, user_id: int, message: str, time: datetime) -> int:
+        """
+        Queue new message for persistence
+
+        Args:
+            chat_id (int): chat id where message was sent
+            user_id (int): sender id
+            message (str): content of message
+            time (datetime): date + time when message was sent
+
+        Returns:
+            int: message id
+        """
+        message_id = self.ids.next()
+        await self.queue.put({'id': message_id, 'chat_id': chat_id, 'sender_id': user_id, 'text': message, 'time': time})
+        return message_id
+
+    async def _run(self):
+        while True:
+            row = await self.queue.get()
+            if row is not None and self.queue.qsize() < self.batch_size:
+                await asyncio.sleep(self.flush_interval)
+            rows = []
+            while row is not None:
+                rows.append(row)
+                if len(rows) >= self.batch_size or self.queue.empty():
+                    break
+                row = self.queue.get_nowait()
+            if rows:
+                await self._flush(rows)
+            if row is None:
+                return
+
+    async def _flush(self, rows: list, attempts: int = 3):
+        for attempt in range(attempts):
+            try:
+                await self._write(rows)
+                break
+            except Exception as e:
+                logger.warning(f"Failed to write {len(rows)} messages (attempt {attempt + 1}): {e}")
+                await asyncio.sleep(0.1 * 2 ** attempt)
+        else:
+            self._spool(rows)
+            return
+        if self.on_flush:
+            try:
+                await self.on_flush(rows)
+            except Exception as e:
+                logger.warning(f"Failed to handle flush of {len(rows)} messages: {e}")
+
+    async def _write(self, rows: list):
+        last_messages = {}
+        for row in rows:
+            if row['id'] > last_messages.get(row['chat_id'], {'id': -1})['id']:
+                last_messages[row['chat_id']] = row
+
+        async with self.session_maker() as session:
+            await session.execute(insert(Message).on_conflict_do_nothing(), rows)
+            chats = Chat.__table__
+            await session.execute(
+                update(chats)
+                .where(chats.c.id == bindparam('chat_id'))
+                .where(chats.c.last_message_id.is_(None) | (chats.c.last_message_id < bindparam('message_id')))
+                .values(
+                    last_message_id=bindparam('message_id'),
+                    last_message_text=bindparam('message_text'),
+                    last_message_time=bindparam('message_time')
+                ),
+                [
+                    {'chat_id': row['chat_id'], 'message_id': row['id'], 'message_text': row['text'], 'message_time': row['time']}
+                    for row in last_messages.values()
+                ]
+            )
+            await session.commit()
+
+    def _spool(self, rows: list):
+        logger.error(f"Spooling {len(rows)} messages to {self.spool_path}")
+        os.makedirs(os.path.dirname(self.spool_path) or ".", exist_ok=True)
+        with open(self.spool_path, 'a') as spool:
+            for row in rows:
+                spool.write(json.dumps({**row, 'time': row['time'].isoformat()}) + '\n')
+
+    async def _replay(self):
+        replay_path = f"{self.spool_path}.{os.getpid()}"
+        try:
+            os.rename(self.spool_path, replay_path)
+        except FileNotFoundError:
+            return
+        with open(replay_path) as spool:
+            rows = [json.loads(line) for line in spool if line.strip()]
+        for row in rows:
+            row['time'] = datetime.fromisoformat(row['time'])
+        for start in range(0, len(rows), self.batch_size):
+            await self._flush(rows[start:start + self.batch_size])
+        os.remove(replay_path)
+        logger.info(f"Replayed {len(rows)} spooled messages")
+
+
+message_writer = MessageWriter()
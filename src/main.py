@@ -1,12 +1,50 @@
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
-from src.api import auth, chat
+from contextlib import asynccontextmanager
+from src.api import auth, chat, cache
 from src.bot.celery_app import *
+from src.db.config import MESSAGE_WRITE_BEHIND
+from src.db.writer import message_writer, WorkerIdLease
+from src.db.db import async_session_maker, poolStats
+from src.metrics import MetricsMiddleware, StatsCollector
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, generate_latest
+from src.db import partitions
+import logging
 
+logger = logging.getLogger(__name__)
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Start and stop background services of the worker
+
+    Args:
+        app (FastAPI): application
+    """
+    try:
+        async with async_session_maker() as session:
+            await partitions.ensurePartitions(session)
+    except Exception as e:
+        # the migration creates partitions ahead and maintain_partitions_task keeps them coming,
+        # a database that isn't ready or migrated yet must not keep the worker down
+        logger.warning(f"Failed to ensure partitions of messages: {e}")
+    await chat.manager.start()
+    lease = WorkerIdLease(cache.redis_client)
+    if MESSAGE_WRITE_BEHIND:
+        await message_writer.start(await lease.acquire(), on_flush=chat.messages_flushed)
+    yield
+    if MESSAGE_WRITE_BEHIND:
+        await message_writer.stop()
+        await lease.release()
+    await chat.manager.stop()
+    await cache.close()
+
+
+app = FastAPI(lifespan=lifespan)
+REGISTRY.register(StatsCollector(chat.manager.stats, poolStats))
 app.mount("/templates", StaticFiles(directory="templates", html=True), name='templates')
 # app.mount("/content", StaticFiles(directory="content", html=True), name='content')
 
@@ -20,6 +58,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
 
 
 templates = Jinja2Templates(directory="templates")
@@ -37,6 +76,16 @@ async def root(request: Request):
     """
     return templates.TemplateResponse(request=request, name="enter.html")
 
+@app.get("/metrics")
+async def metrics():
+    """
+    Endpoint for Prometheus scraping
+
+    Returns:
+        Response: metrics of the worker in text exposition format
+    """
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 # @app.exception_handler(404)
 # async def not_found_handler(request: Request, exc):
 #     return templates.TemplateResponse(request=request, name="error.html")
\ No newline at end of file
@@ -0,0 +1,96 @@
+from prometheus_client import Counter, Histogram
+from prometheus_client.core import GaugeMetricFamily
+from typing import Callable
+import functools
+import time
+
+"""
+    Prometheus metrics of the worker, exported on /metrics
+"""
+
+HTTP_LATENCY = Histogram(
+    "http_request_duration_seconds", "Latency of HTTP requests by route", ["method", "route", "status"]
+)
+WS_FRAMES_IN = Counter("ws_frames_received_total", "WebSocket frames received from clients", ["type"])
+WS_FRAMES_OUT = Counter("ws_frames_sent_total", "WebSocket frames sent to clients")
+FANOUT_DURATION = Histogram(
+    "ws_fanout_duration_seconds", "Time to deliver a message to local connections and publish it for other workers",
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1)
+)
+DB_QUERY_DURATION = Histogram("db_query_duration_seconds", "Duration of CRUD functions", ["function"])
+CACHE_REQUESTS = Counter("cache_requests_total", "Lookups of Redis cache keys", ["cache", "result"])
+NOTIFICATIONS = Counter(
+    "notifications_total", "Telegram notifications queued and digest tasks sent to Celery", ["stage"]
+)
+
+
+def timed(func):
+    """
+    Record duration of coroutine function in DB_QUERY_DURATION, labelled with its name
+    """
+    histogram = DB_QUERY_DURATION.labels(func.__name__)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+    return wrapper
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware observing latency of HTTP requests, labelled with route template instead
+    of path so path parameters don't multiply series
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            HTTP_LATENCY.labels(
+                scope["method"], route.path if route else "unmatched", str(status)
+            ).observe(time.perf_counter() - start)
+
+
+class StatsCollector:
+    """
+    Exports counters computed on scrape, so the hot path doesn't update them
+
+    Args:
+        connection_stats (Callable): returns dict of connection counters, as ConnectionManager.stats
+        pool_stats (Callable): returns dict of pool utilization, as poolStats
+    """
+    def __init__(self, connection_stats: Callable[[], dict], pool_stats: Callable[[], dict]):
+        self.connection_stats = connection_stats
+        self.pool_stats = pool_stats
+
+    def collect(self):
+        for name, value in self.connection_stats().items():
+            yield GaugeMetricFamily(f"ws_{name}", f"WebSocket {name.replace('_', ' ')} of this worker", value=value)
+
+        pools = self.pool_stats()
+        stats = {('primary', 'primary'): pools['primary']}
+        stats.update({('replica', host): replica for host, replica in pools['replicas'].items()})
+        for field in pools['primary']:
+            gauge = GaugeMetricFamily(f"db_pool_{field}", f"Connection pool {field.replace('_', ' ')}", labels=["role", "host"])
+            for labels, pool in stats.items():
+                gauge.add_metric(list(labels), pool[field])
+            yield gauge
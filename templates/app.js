@@ -33,6 +33,7 @@ document.addEventListener("DOMContentLoaded", function () {
                             <div class="flex items-center space-x-2">
                                 <img alt="Profile" class="rounded-full" height="40" src="https://placehold.co/40x40/000/FFF" width="40">
                                 <span>${chat.participant_name}</span>
+                                <span class="unread-badge bg-purple-600 text-white rounded-full px-2 text-xs ${chat.unread_count ? '' : 'hidden'}">${chat.unread_count}</span>
                             </div>
                             <span class="text-gray-500 ml-12">${lastMessageText}</span>
                         </div>
@@ -77,7 +78,9 @@ document.addEventListener("DOMContentLoaded", function () {
                 <div class="flex items-center space-x-2">
                     <img alt="Profile" class="rounded-full" height="40" src="https://placehold.co/40x40/000/FFF" width="40" />
                     <span class="text-lg font-semibold">${chatName}</span>
-                    <span class=" ${data.isOnline ? 'text-green-500' : 'text-red-500'}  text-sm">${data.isOnline ? 'Online' : 'Offline'}</span>
+                    ${data.is_group
+                        ? `<span class="text-gray-500 text-sm">${data.members_count} members</span>`
+                        : `<span id="chat-status" data-user-id="${data.another_uid}" class=" ${data.isOnline ? 'text-green-500' : 'text-red-500'}  text-sm">${data.isOnline ? 'Online' : 'Offline'}</span>`}
                 </div>
             </div>
             <div class="flex-1 overflow-y-auto p-4" id="chat-messages">
@@ -92,17 +95,43 @@ document.addEventListener("DOMContentLoaded", function () {
         `;
 
         const chatMessagesContainer = document.getElementById('chat-messages');
+        let nextBeforeId = data.next_before_id;
+        openChatId = chatId;
+        if (data.messages.length > 0) {
+            sendRead(chatId, data.messages[0].message_id);
+        }
+        let loadingHistory = false;
 
         data.messages.forEach(message => {
-            const messageElement = document.createElement('div');
-            messageElement.className = message.sender_id === data.uid ? 'flex items-end justify-end mb-4' : 'flex items-start mb-4';
-            messageElement.innerHTML = `
-                <span class="${message.sender_id === data.uid ? 'bg-purple-600' : 'bg-gray-700'} text-white rounded-lg px-4 py-2">
-                    ${message.text}
-                    <span class="${message.sender_id === data.uid ? 'text-white-500' : 'text-gray-500'} text-xs ml-2">${formatDate(message.time)}</span>
-                </span>
-            `;
-            chatMessagesContainer.appendChild(messageElement);
+            chatMessagesContainer.prepend(createHistoryMessage(message, data.uid));
+        });
+
+        chatMessagesContainer.addEventListener('scroll', () => {
+            if (chatMessagesContainer.scrollTop > 0 || !nextBeforeId || loadingHistory) {
+                return;
+            }
+            loadingHistory = true;
+            fetch(`/chat/${chatId}?before_id=${nextBeforeId}`)
+                .then(response => {
+                    if (!response.ok) {
+                        throw new Error('Ошибка загрузки истории');
+                    }
+                    return response.json();
+                })
+                .then(page => {
+                    const previousHeight = chatMessagesContainer.scrollHeight;
+                    page.messages.forEach(message => {
+                        chatMessagesContainer.prepend(createHistoryMessage(message, page.uid));
+                    });
+                    chatMessagesContainer.scrollTop = chatMessagesContainer.scrollHeight - previousHeight;
+                    nextBeforeId = page.next_before_id;
+                })
+                .catch(error => {
+                    console.error('Ошибка при загрузке истории:', error);
+                })
+                .finally(() => {
+                    loadingHistory = false;
+                });
         });
 
         document.getElementById('send-button').addEventListener('click', () => {
@@ -149,18 +178,79 @@ document.addEventListener("DOMContentLoaded", function () {
 });
 
 let socket;
+let myUid = null;
+let openChatId = null;
+
+const COMPACT_PROTOCOL = 'chat.compact.v1';
+const JSON_PROTOCOL = 'chat.json.v1';
+
+function decodeFrame(data) {
+    const frame = JSON.parse(data);
+    if (socket.protocol !== COMPACT_PROTOCOL) {
+        return frame;
+    }
+    switch (frame.t) {
+        case 'm':
+            return {
+                type: 'message',
+                message_id: frame.i,
+                chat_id: frame.c,
+                sender_id: frame.s,
+                content: frame.x,
+                time: new Date(frame.ts).toISOString(),
+                isMyMessage: frame.s === myUid
+            };
+        case 's':
+            return { type: 'presence', user_id: frame.u, online: frame.o === 1 };
+        case 'r':
+            return { type: 'read', chat_id: frame.c, user_id: frame.u, message_id: frame.i };
+        case 'p':
+            return { type: 'ping' };
+        case 'h':
+            return { type: 'hello', uid: frame.u };
+        default:
+            return frame;
+    }
+}
 
 function connectWebSocket() {
 
-    socket = new WebSocket("/ws");
+    socket = new WebSocket("/ws", [COMPACT_PROTOCOL, JSON_PROTOCOL]);
 
     socket.onopen = () => {
         console.log('Connected to WebSocket');
     };
 
     socket.onmessage = (event) => {
-        const message = JSON.parse(event.data);
+        const message = decodeFrame(event.data);
+        if (message.type === 'hello') {
+            myUid = message.uid;
+            return;
+        }
+        if (message.type === 'ping') {
+            socket.send(JSON.stringify({ type: 'pong' }));
+            return;
+        }
+        if (message.type === 'presence') {
+            updatePresence(message);
+            return;
+        }
+        if (message.type === 'read') {
+            if (message.user_id === myUid) {
+                setUnread(message.chat_id, 0);
+            }
+            return;
+        }
+        if (message.chat_id !== openChatId) {
+            if (message.sender_id !== myUid) {
+                setUnread(message.chat_id, unreadCount(message.chat_id) + 1);
+            }
+            return;
+        }
         displayMessage(message);
+        if (!message.isMyMessage) {
+            sendRead(message.chat_id, message.message_id);
+        }
     };
 
     socket.onclose = () => {
@@ -172,6 +262,69 @@ function connectWebSocket() {
     };
 }
 
+// Read receipts are sent at most once per READ_INTERVAL_MS with the newest message id,
+// and only while the window has focus, the pending one is sent when it gets focus back
+const READ_INTERVAL_MS = 1000;
+let pendingRead = null;
+let readTimer = null;
+let lastReadSent = 0;
+
+function sendRead(chatId, messageId) {
+    setUnread(chatId, 0);
+    if (pendingRead && pendingRead.chatId === chatId && pendingRead.messageId >= messageId) {
+        return;
+    }
+    if (pendingRead && pendingRead.chatId !== chatId) {
+        flushRead();
+    }
+    pendingRead = { chatId, messageId };
+    if (document.hasFocus() && !readTimer) {
+        readTimer = setTimeout(flushRead, Math.max(0, lastReadSent + READ_INTERVAL_MS - Date.now()));
+    }
+}
+
+function flushRead() {
+    clearTimeout(readTimer);
+    readTimer = null;
+    if (!pendingRead || !socket || socket.readyState !== WebSocket.OPEN) {
+        return;
+    }
+    socket.send(JSON.stringify({ type: 'read', chat_id: pendingRead.chatId, message_id: pendingRead.messageId }));
+    pendingRead = null;
+    lastReadSent = Date.now();
+}
+
+window.addEventListener('focus', flushRead);
+
+function unreadBadge(chatId) {
+    const chatBlock = document.querySelector(`.chat-item[data-chat-id="${chatId}"]`);
+    return chatBlock ? chatBlock.querySelector('.unread-badge') : null;
+}
+
+function unreadCount(chatId) {
+    const badge = unreadBadge(chatId);
+    return badge ? Number(badge.textContent) || 0 : 0;
+}
+
+function setUnread(chatId, count) {
+    const badge = unreadBadge(chatId);
+    if (!badge) {
+        return;
+    }
+    badge.textContent = count;
+    badge.classList.toggle('hidden', count === 0);
+}
+
+function updatePresence(event) {
+    const status = document.getElementById('chat-status');
+    if (!status || Number(status.dataset.userId) !== event.user_id) {
+        return;
+    }
+    status.classList.toggle('text-green-500', event.online);
+    status.classList.toggle('text-red-500', !event.online);
+    status.textContent = event.online ? 'Online' : 'Offline';
+}
+
 function displayMessage(message) {
     const chatMessagesContainer = document.getElementById('chat-messages');
 
@@ -186,6 +339,18 @@ function displayMessage(message) {
     chatMessagesContainer.appendChild(messageElement);
 }
 
+function createHistoryMessage(message, uid) {
+    const messageElement = document.createElement('div');
+    messageElement.className = message.sender_id === uid ? 'flex items-end justify-end mb-4' : 'flex items-start mb-4';
+    messageElement.innerHTML = `
+        <span class="${message.sender_id === uid ? 'bg-purple-600' : 'bg-gray-700'} text-white rounded-lg px-4 py-2">
+            ${message.text}
+            <span class="${message.sender_id === uid ? 'text-white-500' : 'text-gray-500'} text-xs ml-2">${formatDate(message.time)}</span>
+        </span>
+    `;
+    return messageElement;
+}
+
 function formatDate(dateString) {
     const date = new Date(dateString);
     const day = String(date.getUTCDate()).padStart(2, '0');
@@ -211,7 +376,7 @@ async function fetchUsers() {
         const userList = document.getElementById('user-list');
         userList.innerHTML = '';
 
-        users.forEach(user => {
+        users.filter(user => user.id !== myUid).forEach(user => {
             const userItem = document.createElement('div');
             userItem.classList.add('flex', 'items-center', 'justify-between', 'p-2', 'text-white');
             userItem.innerHTML = `